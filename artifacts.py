@@ -0,0 +1,93 @@
+import os, time, hashlib, asyncio, logging
+import httpx
+from sqlitestore import SQLiteStore, HitStats
+
+# --- کش فایل‌های تولیدشده (لوگو، کاور، ویس): file_id تلگرام و در صورت تمایل خود فایل روی دیسک ---
+logger = logging.getLogger(__name__)
+
+ARTIFACT_CACHE_PATH = os.environ.get("ARTIFACT_CACHE_PATH", "artifacts.sqlite3")
+ARTIFACT_CACHE_SIZE = int(os.environ.get("ARTIFACT_CACHE_SIZE", 5000))
+ARTIFACT_DIR = os.environ.get("ARTIFACT_DIR") # اگر خالی باشد فقط file_id نگه داشته می‌شود
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (key TEXT PRIMARY KEY, kind TEXT, file_id TEXT, path TEXT, created REAL, accessed REAL);
+CREATE INDEX IF NOT EXISTS artifacts_accessed ON artifacts (accessed);
+"""
+
+
+def artifact_key(kind, *parts):
+    # ۳۲ نویسه هگز تا همراه پیشوند در callback_data تلگرام (۶۴ بایت) جا شود
+    return hashlib.sha256('\0'.join((kind,) + parts).encode()).hexdigest()[:32]
+
+
+class ArtifactCache(SQLiteStore, HitStats):
+    """Generated media keyed on a hash of what produced it.
+
+    Each entry holds the Telegram ``file_id`` from the first send, so the
+    same file can be sent again without generating or uploading it. With
+    ``directory`` set the bytes are kept there too, for when a ``file_id``
+    stops working. Entries are trimmed to ``maxsize`` by least-recent access.
+    """
+
+    def __init__(self, path=ARTIFACT_CACHE_PATH, directory=ARTIFACT_DIR, maxsize=ARTIFACT_CACHE_SIZE):
+        self.directory, self.maxsize = directory, maxsize
+        if directory: os.makedirs(directory, exist_ok=True)
+        self._open(path, SCHEMA)
+
+    def _get(self, key):
+        row = self._db.execute("SELECT kind, file_id, path FROM artifacts WHERE key = ?", (key,)).fetchone()
+        if row is None: return None
+        self._db.execute("UPDATE artifacts SET accessed = ? WHERE key = ?", (time.time(), key))
+        return {'key': key, 'kind': row[0], 'file_id': row[1], 'path': row[2]}
+
+    def _put(self, key, kind, file_id, data):
+        path = None
+        if self.directory and data:
+            path = os.path.join(self.directory, key)
+            with open(path, 'wb') as f: f.write(data)
+        else:
+            row = self._db.execute("SELECT path FROM artifacts WHERE key = ?", (key,)).fetchone()
+            path = row[0] if row else None
+        now = time.time()
+        self._db.execute("INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?)", (key, kind, file_id, path, now, now))
+        overflow = self._db.execute("SELECT COUNT(*) FROM artifacts").fetchone()[0] - self.maxsize
+        if overflow > 0:
+            old = self._db.execute("SELECT key, path FROM artifacts ORDER BY accessed LIMIT ?", (overflow,)).fetchall()
+            self._db.executemany("DELETE FROM artifacts WHERE key = ?", [(k,) for k, _ in old])
+            for _, p in old: self._unlink(p)
+
+    def _drop(self, key):
+        row = self._db.execute("SELECT path FROM artifacts WHERE key = ?", (key,)).fetchone()
+        self._db.execute("DELETE FROM artifacts WHERE key = ?", (key,))
+        if row: self._unlink(row[0])
+
+    @staticmethod
+    def _unlink(path):
+        if not path: return
+        try: os.remove(path)
+        except FileNotFoundError: pass
+
+    async def get(self, key):
+        entry = await self._run(self._get, key)
+        self._count(entry is not None)
+        return entry
+
+    async def put(self, key, kind, file_id, data=None, url=None):
+        """Remember ``file_id``; bytes come from ``data`` or are fetched from ``url`` if a directory is set."""
+        if self.directory and data is None and url:
+            try:
+                async with httpx.AsyncClient(timeout=30) as client:
+                    res = await client.get(url); res.raise_for_status(); data = res.content
+            except httpx.HTTPError as e: logger.warning(f"Could not keep a copy of artifact {key}: {e}")
+        await self._run(self._put, key, kind, file_id, data)
+
+    async def read(self, entry):
+        """Stored bytes of ``entry``, or None if none were kept."""
+        if not entry.get('path'): return None
+        def load():
+            with open(entry['path'], 'rb') as f: return f.read()
+        try: return await asyncio.to_thread(load)
+        except OSError: return None
+
+    async def drop(self, key):
+        await self._run(self._drop, key)
@@ -0,0 +1,101 @@
+import re, struct
+
+# --- ابزارهای صوتی: تقسیم متن برای TTS و اتصال فایل‌های Ogg Opus ---
+SENTENCE_END = re.compile(r'(?<=[.!?؟۔…])\s+|\n+')
+
+
+def split_text(text, max_chars=800, first_chars=None):
+    """Split ``text`` on sentence boundaries into chunks of at most ``max_chars``.
+
+    ``first_chars`` caps the first chunk separately (where sentence boundaries
+    allow) so a short preview can be synthesized first. Sentences longer than
+    ``max_chars`` are split on whitespace; no text is dropped.
+    """
+    pieces = []
+    for sentence in filter(None, (s.strip() for s in SENTENCE_END.split(text))):
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(' ', 0, max_chars)
+            if cut <= 0: cut = max_chars
+            pieces.append(sentence[:cut].strip()); sentence = sentence[cut:].strip()
+        if sentence: pieces.append(sentence)
+    chunks = []
+    for p in pieces:
+        limit = first_chars if first_chars and len(chunks) == 1 else max_chars
+        if chunks and len(chunks[-1]) + 1 + len(p) <= limit: chunks[-1] += ' ' + p
+        else: chunks.append(p)
+    return chunks
+
+
+# --- Ogg ---
+def _crc_table():
+    table = []
+    for i in range(256):
+        r = i << 24
+        for _ in range(8): r = ((r << 1) ^ 0x04C11DB7) & 0xFFFFFFFF if r & 0x80000000 else (r << 1) & 0xFFFFFFFF
+        table.append(r)
+    return table
+_CRC = _crc_table()
+
+
+def ogg_crc(data):
+    crc = 0
+    for b in data: crc = ((crc << 8) & 0xFFFFFFFF) ^ _CRC[((crc >> 24) & 0xFF) ^ b]
+    return crc
+
+
+_HEADER = struct.Struct('<4sBBqIIIB')
+NO_GRANULE = -1
+
+
+def parse_pages(data):
+    """Return the Ogg pages in ``data`` as ``[flags, granule, serial, segments, body]`` lists."""
+    pages, pos = [], 0
+    while pos < len(data):
+        magic, version, flags, granule, serial, seq, crc, nseg = _HEADER.unpack_from(data, pos)
+        if magic != b'OggS': raise ValueError(f"Not an Ogg page at offset {pos}")
+        seg_start = pos + _HEADER.size
+        segments = data[seg_start:seg_start + nseg]
+        body_start = seg_start + nseg
+        body_len = sum(segments)
+        pages.append([flags, granule, serial, bytes(segments), data[body_start:body_start + body_len]])
+        pos = body_start + body_len
+    return pages
+
+
+def build_page(flags, granule, serial, seq, segments, body):
+    header = _HEADER.pack(b'OggS', 0, flags, granule, serial, seq, 0, len(segments)) + segments
+    page = bytearray(header + body)
+    struct.pack_into('<I', page, 22, ogg_crc(page))
+    return bytes(page)
+
+
+def _header_page_count(pages):
+    # صفحه اول OpusHead است؛ OpusTags تا صفحه‌ای ادامه دارد که بسته آن تمام شود
+    for i, p in enumerate(pages[1:], 1):
+        if p[3] and p[3][-1] < 255: return i + 1
+    return len(pages)
+
+
+def merge_ogg_opus(parts):
+    """Join several Ogg Opus files from the same encoder settings into one logical stream.
+
+    Headers of the first file are kept; audio pages of the others are appended
+    with the serial number, page sequence and granule positions rewritten, so
+    the result plays as one continuous voice note.
+    """
+    parts = [parse_pages(p) for p in parts if p]
+    if not parts: return b''
+    serial = parts[0][0][2]
+    out, seq, offset = [], 0, 0
+    for n, pages in enumerate(parts):
+        headers = _header_page_count(pages)
+        last_granule = 0
+        for i, (flags, granule, _, segments, body) in enumerate(pages[0 if n == 0 else headers:], 0 if n == 0 else headers):
+            flags &= ~0x04
+            if n: flags &= ~0x02
+            if n == len(parts) - 1 and i == len(pages) - 1: flags |= 0x04
+            if granule != NO_GRANULE and i >= headers:
+                last_granule = granule; granule += offset
+            out.append(build_page(flags, granule, serial, seq, segments, body)); seq += 1
+        offset += last_granule
+    return b''.join(out)
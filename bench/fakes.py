@@ -0,0 +1,222 @@
+import json, time, random, asyncio, itertools
+from collections import Counter
+from email.parser import BytesParser
+from urllib.parse import parse_qs
+from server import HttpServer
+from audio import build_page
+
+# --- شبیه‌سازهای محلی Telegram Bot API، OpenAI و PostgREST برای بنچمارک ---
+
+
+class FakeServer(HttpServer):
+    """HttpServer that hands every request to ``handle`` instead of exact-path routes."""
+
+    def __init__(self):
+        super().__init__(max_body=64 * 1024 * 1024)
+        self.port = None
+        self.requests = Counter()
+
+    async def start(self, host='127.0.0.1', port=0):
+        await super().start(host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    async def _dispatch(self, request):
+        self.requests[request.path] += 1
+        try: return await self.handle(request)
+        except Exception as e:
+            return 500, json.dumps({'error': str(e)}), 'application/json'
+
+
+def parse_params(request):
+    ctype = request.headers.get('content-type', '')
+    if ctype.startswith('application/json'): return json.loads(request.body or b'{}')
+    if ctype.startswith('multipart/form-data'):
+        msg = BytesParser().parsebytes(b'Content-Type: ' + ctype.encode() + b'\r\n\r\n' + request.body)
+        params = {}
+        for part in msg.get_payload():
+            name = part.get_param('name', header='content-disposition')
+            params[name] = part.get_payload(decode=True) if part.get_filename() else part.get_payload(decode=True).decode()
+        return params
+    return {k: v[0] for k, v in parse_qs(request.body.decode()).items()}
+
+
+def tiny_ogg_opus(serial=1, frames=50):
+    # فایل Ogg Opus کوچک با سرآیندهای معتبر؛ برای شبیه‌سازی خروجی TTS
+    head = b'OpusHead' + bytes([1, 1]) + (312).to_bytes(2, 'little') + (48000).to_bytes(4, 'little') + bytes(3)
+    tags = b'OpusTags' + (5).to_bytes(4, 'little') + b'bench' + bytes(4)
+    pages = [build_page(2, 0, serial, 0, bytes([len(head)]), head), build_page(0, 0, serial, 1, bytes([len(tags)]), tags)]
+    for i in range(frames):
+        pages.append(build_page(4 if i == frames - 1 else 0, 312 + 960 * (i + 1), serial, i + 2, bytes([3]), b'\xf8\xff\xfe'))
+    return b''.join(pages)
+
+
+class FakeTelegram(FakeServer):
+    """Bot API stand-in: accepts every method and returns plausible objects."""
+
+    def __init__(self, token):
+        super().__init__()
+        self.token = token
+        self.ids = itertools.count(1000)
+        self.calls = Counter()
+        self.errors = 0
+
+    def _message(self, params, **extra):
+        chat_id = int(params.get('chat_id') or 1)
+        msg = {'message_id': next(self.ids), 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}}
+        if 'text' in params: msg['text'] = params['text']
+        return {**msg, **extra}
+
+    async def handle(self, request):
+        if request.path.startswith('/file/'): return 200, b'\xff\xd8' + bytes(64 * 1024) + b'\xff\xd9', 'application/octet-stream'
+        method = request.path.rsplit('/', 1)[-1]
+        params = parse_params(request) if request.body else {}
+        self.calls[method] += 1
+        if '❌' in str(params.get('text', '')): self.errors += 1
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot',
+                      'can_join_groups': False, 'can_read_all_group_messages': False, 'supports_inline_queries': False}
+        elif method == 'getFile':
+            result = {'file_id': params.get('file_id', 'f'), 'file_unique_id': 'u', 'file_size': 64 * 1024, 'file_path': f"media/{params.get('file_id', 'f')}"}
+        elif method == 'sendPhoto':
+            file_id = params['photo'] if isinstance(params.get('photo'), str) and not params['photo'].startswith('http') else f"photo{next(self.ids)}"
+            result = self._message(params, photo=[{'file_id': file_id, 'file_unique_id': file_id, 'width': 1024, 'height': 1024}])
+        elif method == 'sendVoice':
+            file_id = params['voice'] if isinstance(params.get('voice'), str) else f"voice{next(self.ids)}"
+            result = self._message(params, voice={'file_id': file_id, 'file_unique_id': file_id, 'duration': 20})
+        elif method in ('sendMessage', 'editMessageText', 'editMessageCaption'):
+            result = self._message(params)
+        else: result = True
+        return 200, json.dumps({'ok': True, 'result': result}), 'application/json'
+
+
+class FakeOpenAI(FakeServer):
+    """OpenAI stand-in with configurable latency; chat completions support streaming.
+
+    ``rate_limit`` is the fraction of requests answered with 429 and a short
+    ``Retry-After``, to exercise the client's backoff.
+    """
+
+    def __init__(self, latency=1.0, token_delay=0.02, jitter=0.2, rate_limit=0.0):
+        super().__init__()
+        self.latency, self.token_delay, self.jitter, self.rate_limit = latency, token_delay, jitter, rate_limit
+        self.tokens = Counter()
+        self.throttled = 0
+
+    async def _wait(self, scale=1.0):
+        await asyncio.sleep(max(0.0, self.latency * scale * random.uniform(1 - self.jitter, 1 + self.jitter)))
+
+    @staticmethod
+    def _reply(body):
+        if body.get('response_format', {}).get('type') == 'json_object':
+            return json.dumps({'ideas': [{'type': t, 'title': f"{t} idea", 'hook': 'hook'} for t in ('myth', 'story', 'list')]})
+        return ' '.join(f"کلمه{i}." if i % 12 == 11 else f"کلمه{i}" for i in range(120))
+
+    async def handle(self, request):
+        path = request.path.removeprefix('/v1')
+        if random.random() < self.rate_limit:
+            self.throttled += 1
+            return 429, json.dumps({'error': {'message': 'Rate limit reached', 'type': 'requests', 'code': 'rate_limit_exceeded'}}), 'application/json', {'Retry-After': '0.2'}
+        if path == '/chat/completions':
+            body = json.loads(request.body)
+            text, model = self._reply(body), body['model']
+            words = text.split(' ')
+            self.tokens[model] += len(words)
+            if body.get('stream'):
+                async def sse():
+                    await self._wait(0.2)
+                    for w in words:
+                        chunk = {'id': 'c', 'object': 'chat.completion.chunk', 'created': 0, 'model': model,
+                                 'choices': [{'index': 0, 'delta': {'content': w + ' '}, 'finish_reason': None}]}
+                        yield f"data: {json.dumps(chunk)}\n\n"
+                        await asyncio.sleep(self.token_delay)
+                    yield "data: [DONE]\n\n"
+                return 200, sse(), 'text/event-stream'
+            await self._wait()
+            return 200, json.dumps({'id': 'c', 'object': 'chat.completion', 'created': 0, 'model': model,
+                                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+                                    'usage': {'prompt_tokens': 50, 'completion_tokens': len(words), 'total_tokens': 50 + len(words)}}), 'application/json'
+        if path == '/images/generations':
+            await self._wait(3)
+            return 200, json.dumps({'created': 0, 'data': [{'url': 'https://example.invalid/image.png'}]}), 'application/json'
+        if path == '/audio/speech':
+            await self._wait(0.5)
+            return 200, tiny_ogg_opus(random.randint(1, 2 ** 31)), 'audio/ogg'
+        if path == '/audio/transcriptions':
+            await self._wait(0.5)
+            return 200, json.dumps({'text': 'متن صوتی'}), 'application/json'
+        return 404, b'', 'text/plain'
+
+
+class FakePostgrest(FakeServer):
+    """In-memory subset of PostgREST for the tables and RPC functions the bot uses."""
+
+    def __init__(self, latency=0.03):
+        super().__init__()
+        self.latency = latency
+        self.tables = {'profiles': [], 'logs': []}
+        self.counters = {}
+
+    @staticmethod
+    def _filters(query):
+        out = []
+        for k, v in parse_qs(query).items():
+            if k in ('select', 'limit', 'on_conflict', 'order'): continue
+            op, _, arg = v[0].partition('.')
+            out.append((k, op, arg))
+        return out
+
+    @staticmethod
+    def _match(row, filters):
+        for k, op, arg in filters:
+            val = str(row.get(k))
+            if op == 'eq' and val != arg: return False
+            if op == 'in' and val not in arg.strip('()').split(','): return False
+            if op == 'gte' and val < arg: return False
+        return True
+
+    def _rpc(self, name, p):
+        key = (p['p_user_id'], p['p_day'])
+        used, reserved = self.counters.get(key, (0, 0))
+        if name == 'reserve_quota':
+            ok = used + reserved < p['p_allowance']
+            if ok: reserved += 1
+            self.counters[key] = (used, reserved)
+            return {'ok': ok, 'total': used + reserved}
+        if name == 'commit_quota': self.counters[key] = (used + 1, max(0, reserved - 1))
+        if name == 'refund_quota': self.counters[key] = (used, max(0, reserved - 1))
+        if name == 'quota_usage': return used + reserved
+        return None
+
+    async def handle(self, request):
+        await asyncio.sleep(self.latency)
+        path = request.path.removeprefix('/rest/v1/')
+        if path.startswith('rpc/'):
+            result = self._rpc(path[4:], json.loads(request.body or b'{}'))
+            return (200, json.dumps(result), 'application/json') if result is not None else (204, b'', 'application/json')
+        rows = self.tables.setdefault(path, [])
+        filters = self._filters(request.query)
+        if request.method in ('GET', 'HEAD'):
+            found = [r for r in rows if self._match(r, filters)]
+            if request.method == 'HEAD':
+                return 200, b'', 'application/json', {'Content-Range': f"0-0/{len(found)}"}
+            return 200, json.dumps(found[:int(parse_qs(request.query).get('limit', [len(found) or 1])[0])]), 'application/json'
+        if request.method == 'POST':
+            data = json.loads(request.body)
+            out = []
+            conflict = parse_qs(request.query).get('on_conflict', [None])[0]
+            for item in data if isinstance(data, list) else [data]:
+                existing = next((r for r in rows if conflict and r.get(conflict) == item.get(conflict)), None)
+                if existing: existing.update(item); out.append(existing)
+                else:
+                    row = {'id': len(rows) + 1, 'is_vip': False, **item} if path == 'profiles' else {'id': len(rows) + 1, **item}
+                    rows.append(row); out.append(row)
+            return 201, json.dumps(out) if 'representation' in request.headers.get('prefer', '') else b'', 'application/json'
+        if request.method == 'PATCH':
+            for r in rows:
+                if self._match(r, filters): r.update(json.loads(request.body))
+            return 204, b'', 'application/json'
+        return 405, b'', 'text/plain'
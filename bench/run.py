@@ -0,0 +1,198 @@
+"""Offline load test: runs the real handlers in main.py against local fakes.
+
+    python -m bench.run --max-users 64 --openai-latency 2 --slo 10
+
+Reports per-step handler latency (p50/p95/p99), event-loop lag, Supabase and
+OpenAI round-trips per flow, and the highest concurrency level whose p95 stays
+under ``--slo`` with no user-visible errors.
+"""
+import os, json, time, random, asyncio, logging, argparse, tempfile, itertools
+from collections import defaultdict
+from bench.fakes import FakeTelegram, FakeOpenAI, FakePostgrest
+
+TOKEN = "123456:BENCH"
+ADMIN_ID = 999_999
+
+FLOWS = {
+    'scenario': [('text', '🎬 سناریوساز استراتژیک'), ('text', 'همه می‌گویند قهوه مضر است'), ('callback', 'emo_warn'), ('callback', 'expand_0')],
+    'coach': [('text', '🧠 مربی ایده و آنالیزور'), ('text', 'ایده: سه اشتباه رایج در دم کردن قهوه')],
+    'hashtag': [('text', '🏷 هشتگ‌ساز'), ('topic', None)],
+    'logo': [('text', '🎨 طراحی لوگو (VIP)'), ('callback', 'logo_mode_auto'), ('callback', 'ls_minimal')],
+    'vip_receipt': [('text', '💎 ارتقا VIP'), ('photo', None), ('admin', 'v_p_{uid}')],
+}
+VIP_FLOWS = {'logo'}
+TOPICS = ['کافه', 'باشگاه', 'آرایشگاه', 'کتاب', 'سفر']
+
+
+def percentile(values, p):
+    if not values: return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class Driver:
+    """Feeds synthetic updates to the application and records per-step latency."""
+
+    def __init__(self, app):
+        self.app = app
+        self.ids = itertools.count(1)
+        self.latency = defaultdict(list)
+
+    def _user(self, uid):
+        return {'id': uid, 'is_bot': False, 'first_name': f"user{uid}"}
+
+    def _message(self, uid, **extra):
+        return {'message_id': next(self.ids), 'date': int(time.time()), 'chat': {'id': uid, 'type': 'private'}, 'from': self._user(uid), **extra}
+
+    def _callback(self, uid, data):
+        return {'callback_query': {'id': str(next(self.ids)), 'from': self._user(uid), 'chat_instance': 'bench', 'data': data,
+                                   'message': self._message(uid, text='…', caption='…')}}
+
+    async def send(self, label, data):
+        from telegram import Update
+        update = Update.de_json({'update_id': next(self.ids), **data}, self.app.bot)
+        started = time.perf_counter()
+        await self.app.process_update(update)
+        self.latency[label].append(time.perf_counter() - started)
+
+    async def command(self, uid, name):
+        text = f"/{name}"
+        await self.send(text, {'message': self._message(uid, text=text, entities=[{'type': 'bot_command', 'offset': 0, 'length': len(text)}])})
+
+    async def run_flow(self, flow, uid):
+        for i, (kind, arg) in enumerate(FLOWS[flow]):
+            label = f"{flow}.{i + 1}"
+            if kind == 'text': await self.send(label, {'message': self._message(uid, text=arg)})
+            elif kind == 'topic': await self.send(label, {'message': self._message(uid, text=random.choice(TOPICS))})
+            elif kind == 'callback': await self.send(label, self._callback(uid, arg))
+            elif kind == 'admin': await self.send(label, self._callback(ADMIN_ID, arg.format(uid=uid)))
+            elif kind == 'photo':
+                photo = [{'file_id': f"p{uid}_s", 'file_unique_id': 's', 'width': 90, 'height': 90, 'file_size': 2000},
+                         {'file_id': f"p{uid}_l", 'file_unique_id': 'l', 'width': 1280, 'height': 1280, 'file_size': 65536}]
+                await self.send(label, {'message': self._message(uid, photo=photo)})
+
+
+async def loop_lag(samples, interval=0.01):
+    loop = asyncio.get_running_loop()
+    while True:
+        t = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - t - interval))
+
+
+def seed_users(pg, uids, vip):
+    for uid in uids:
+        pg.tables['profiles'].append({'id': len(pg.tables['profiles']) + 1, 'user_id': str(uid), 'business': random.choice(TOPICS), 'goal': 'goal_sales',
+                                      'audience': 'جوانان', 'tone': 'tone_friendly', 'is_vip': vip})
+
+
+def non_log_requests(server):
+    return sum(n for path, n in server.requests.items() if not path.endswith('/logs'))
+
+
+async def calibrate(driver, pg, oa, next_uid):
+    # هر جریان یک‌بار با کاربر تازه (کش سرد) و یک‌بار دوباره (کش گرم) اجرا می‌شود
+    rows = {}
+    for flow in FLOWS:
+        uid = next_uid(); seed_users(pg, [uid], flow in VIP_FLOWS)
+        counts = []
+        for _ in range(2):
+            await driver.command(uid, 'cancel')
+            db0, ai0 = non_log_requests(pg), sum(oa.requests.values())
+            await driver.run_flow(flow, uid)
+            counts.append((non_log_requests(pg) - db0, sum(oa.requests.values()) - ai0))
+        rows[flow] = counts
+    return rows
+
+
+async def ramp(driver, pg, tg, next_uid, max_users, slo):
+    results = []
+    level = 1
+    while level <= max_users:
+        flows = []
+        for _ in range(level):
+            uid = next_uid(); flow = random.choice(list(FLOWS))
+            seed_users(pg, [uid], flow in VIP_FLOWS); flows.append((flow, uid))
+        driver.latency.clear(); errors0 = tg.errors
+        started = time.perf_counter()
+        await asyncio.gather(*(driver.run_flow(f, u) for f, u in flows))
+        elapsed = time.perf_counter() - started
+        all_lat = [x for v in driver.latency.values() for x in v]
+        p95, errors = percentile(all_lat, 95), tg.errors - errors0
+        results.append({'users': level, 'p50': percentile(all_lat, 50), 'p95': p95, 'p99': percentile(all_lat, 99),
+                        'errors': errors, 'flows_per_s': level / elapsed, 'ok': p95 <= slo and errors == 0,
+                        'steps': {k: (percentile(v, 50), percentile(v, 95), percentile(v, 99)) for k, v in sorted(driver.latency.items())}})
+        level *= 2
+    return results
+
+
+async def main_async(args):
+    random.seed(args.seed)
+    tg, oa, pg = FakeTelegram(TOKEN), FakeOpenAI(args.openai_latency, args.token_delay, rate_limit=args.openai_429), FakePostgrest(args.db_latency)
+    for s in (tg, oa, pg): await s.start()
+    tmp = tempfile.mkdtemp(prefix='bench-')
+    os.environ.update({
+        'TELEGRAM_TOKEN': TOKEN, 'TELEGRAM_BASE_URL': tg.url, 'ADMIN_ID': str(ADMIN_ID),
+        'OPENAI_API_KEY': 'bench', 'OPENAI_BASE_URL': f"{oa.url}/v1",
+        'SUPABASE_URL': pg.url, 'SUPABASE_KEY': 'bench', 'QUOTA_BACKEND': 'supabase',
+        'RESPONSE_CACHE_PATH': os.path.join(tmp, 'responses.sqlite3'), 'ARTIFACT_CACHE_PATH': os.path.join(tmp, 'artifacts.sqlite3'),
+        'BULK_DB_PATH': os.path.join(tmp, 'bulk.sqlite3'), 'QUOTA_DB_PATH': os.path.join(tmp, 'quota.sqlite3'), 'HOST': '127.0.0.1', 'PORT': '0',
+    })
+    import main
+    logging.getLogger().setLevel(logging.WARNING)
+    app = main.build_app()
+    await app.initialize(); await main.on_startup(app)
+    lag = []
+    lag_task = asyncio.create_task(loop_lag(lag))
+    uids = itertools.count(10_000)
+    driver = Driver(app)
+    try:
+        calibration = await calibrate(driver, pg, oa, lambda: next(uids))
+        lag.clear()
+        levels = await ramp(driver, pg, tg, lambda: next(uids), args.max_users, args.slo)
+    finally:
+        lag_task.cancel()
+        await main.on_shutdown(app); await app.shutdown()
+        for s in (tg, oa, pg): await s.close()
+    report = {'calibration': calibration, 'levels': levels,
+              'loop_lag': {'p50': percentile(lag, 50), 'p99': percentile(lag, 99), 'max': max(lag, default=0.0)},
+              'max_sustainable_users': max((l['users'] for l in levels if l['ok']), default=0),
+              'openai_tokens': dict(oa.tokens), 'openai_throttled': oa.throttled, 'telegram_calls': dict(tg.calls)}
+    print_report(report, args.slo)
+    if args.json:
+        with open(args.json, 'w') as f: json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+def print_report(r, slo):
+    print("\nRound-trips per flow (cold → warm)")
+    print(f"{'flow':<14}{'db':>10}{'openai':>10}")
+    for flow, ((db1, ai1), (db2, ai2)) in r['calibration'].items():
+        print(f"{flow:<14}{f'{db1}→{db2}':>10}{f'{ai1}→{ai2}':>10}")
+    print(f"\nConcurrency ramp (SLO p95 ≤ {slo:.1f}s)")
+    print(f"{'users':>6}{'p50':>8}{'p95':>8}{'p99':>8}{'flows/s':>9}{'errors':>8}  ok")
+    for l in r['levels']:
+        print(f"{l['users']:>6}{l['p50']:>8.2f}{l['p95']:>8.2f}{l['p99']:>8.2f}{l['flows_per_s']:>9.2f}{l['errors']:>8}  {'✔' if l['ok'] else '✘'}")
+    last = r['levels'][-1] if r['levels'] else None
+    if last:
+        print(f"\nPer-step latency at {last['users']} users (p50 / p95 / p99, s)")
+        for step, (p50, p95, p99) in last['steps'].items(): print(f"  {step:<16}{p50:>7.2f}{p95:>7.2f}{p99:>7.2f}")
+    lag = r['loop_lag']
+    print(f"\nEvent-loop lag: p50 {lag['p50'] * 1000:.1f} ms | p99 {lag['p99'] * 1000:.1f} ms | max {lag['max'] * 1000:.1f} ms")
+    print(f"Max sustainable concurrency: {r['max_sustainable_users']} users")
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument('--max-users', type=int, default=64)
+    p.add_argument('--openai-latency', type=float, default=1.0, help="seconds per non-streamed OpenAI call")
+    p.add_argument('--token-delay', type=float, default=0.01, help="seconds between streamed tokens")
+    p.add_argument('--openai-429', type=float, default=0.0, help="fraction of OpenAI requests rejected with 429")
+    p.add_argument('--db-latency', type=float, default=0.03, help="seconds per PostgREST request")
+    p.add_argument('--slo', type=float, default=10.0, help="p95 handler latency budget in seconds")
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--json', help="also write the full report to this file")
+    return p.parse_args(argv)
+
+
+if __name__ == '__main__':
+    asyncio.run(main_async(parse_args()))
@@ -0,0 +1,77 @@
+import os, json, time
+from sqlitestore import SQLiteStore
+
+# --- وضعیت کارهای تقویم محتوا (تولید دسته‌ای سناریو) و پیشرفت هر مورد ---
+BULK_DB_PATH = os.environ.get("BULK_DB_PATH", "bulk.sqlite3")
+BULK_CONCURRENCY = int(os.environ.get("BULK_CONCURRENCY", 4))
+BULK_MAX_ITEMS = int(os.environ.get("BULK_MAX_ITEMS", 31))
+BULK_BATCH = os.environ.get("BULK_BATCH", "0") == "1" # ارسال از طریق Batch API اوپن‌ای‌آی به‌جای فراخوانی مستقیم
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT, chat_id INTEGER, profile TEXT,
+                                 status TEXT, batch_id TEXT, batch_stage TEXT, created REAL);
+CREATE TABLE IF NOT EXISTS items (job_id INTEGER, idx INTEGER, claim TEXT, idea TEXT, script TEXT, state TEXT,
+                                  PRIMARY KEY (job_id, idx));
+"""
+
+
+class BulkStore(SQLiteStore):
+    """Content-calendar jobs and the progress of each of their items, in SQLite.
+
+    A job is ``running`` until every item is delivered (``done``), or
+    ``paused`` when it stopped with items left. Items move through
+    ``pending`` → ``idea`` → ``script`` → ``sent``, and each step is written
+    as soon as it finishes, so a restarted job only redoes unfinished steps.
+    """
+
+    def __init__(self, path=BULK_DB_PATH):
+        self._open(path, SCHEMA, timeout=30)
+
+    def _create(self, user_id, chat_id, profile, claims):
+        with self._db:
+            self._db.execute("BEGIN")
+            job_id = self._db.execute("INSERT INTO jobs (user_id, chat_id, profile, status, created) VALUES (?, ?, ?, 'running', ?)",
+                                      (str(user_id), chat_id, json.dumps(profile, ensure_ascii=False), time.time())).lastrowid
+            self._db.executemany("INSERT INTO items (job_id, idx, claim, state) VALUES (?, ?, ?, 'pending')",
+                                 [(job_id, i, c) for i, c in enumerate(claims)])
+        return job_id
+
+    @staticmethod
+    def _job_row(row):
+        return {'id': row[0], 'user_id': row[1], 'chat_id': row[2], 'profile': json.loads(row[3]), 'status': row[4],
+                'batch_id': row[5], 'batch_stage': row[6]} if row else None
+
+    def _job(self, job_id):
+        return self._job_row(self._db.execute("SELECT id, user_id, chat_id, profile, status, batch_id, batch_stage FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def _jobs(self, status, user_id):
+        sql, args = "SELECT id, user_id, chat_id, profile, status, batch_id, batch_stage FROM jobs WHERE status = ?", [status]
+        if user_id is not None: sql += " AND user_id = ?"; args.append(str(user_id))
+        return [self._job_row(r) for r in self._db.execute(sql + " ORDER BY id", args).fetchall()]
+
+    def _items(self, job_id):
+        rows = self._db.execute("SELECT idx, claim, idea, script, state FROM items WHERE job_id = ? ORDER BY idx", (job_id,)).fetchall()
+        return [{'idx': r[0], 'claim': r[1], 'idea': json.loads(r[2]) if r[2] else None, 'script': r[3], 'state': r[4]} for r in rows]
+
+    def _update(self, table, where, fields):
+        if 'idea' in fields: fields = {**fields, 'idea': json.dumps(fields['idea'], ensure_ascii=False)}
+        cols = ', '.join(f"{k} = ?" for k in fields)
+        self._db.execute(f"UPDATE {table} SET {cols} WHERE {' AND '.join(f'{k} = ?' for k in where)}", [*fields.values(), *where.values()])
+
+    async def create(self, user_id, chat_id, profile, claims):
+        return await self._run(self._create, user_id, chat_id, profile, claims)
+
+    async def job(self, job_id):
+        return await self._run(self._job, job_id)
+
+    async def jobs(self, status='running', user_id=None):
+        return await self._run(self._jobs, status, user_id)
+
+    async def items(self, job_id):
+        return await self._run(self._items, job_id)
+
+    async def update_job(self, job_id, **fields):
+        await self._run(self._update, 'jobs', {'id': job_id}, fields)
+
+    async def update_item(self, job_id, idx, **fields):
+        await self._run(self._update, 'items', {'job_id': job_id, 'idx': idx}, fields)
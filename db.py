@@ -0,0 +1,71 @@
+import os, time, asyncio, logging
+import httpx
+import metrics
+
+# --- لایه دسترسی به داده (PostgREST سوپابیس) ---
+logger = logging.getLogger(__name__)
+
+SUPABASE_URL = os.environ.get("SUPABASE_URL")
+SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
+DB_MAX_CONNECTIONS = int(os.environ.get("DB_MAX_CONNECTIONS", 20))
+DB_TIMEOUT = float(os.environ.get("DB_TIMEOUT", 10))
+
+
+class Repository:
+    """Typed async access to the bot's Supabase tables over one keep-alive connection pool."""
+
+    def __init__(self, url, key, max_connections=DB_MAX_CONNECTIONS, timeout=DB_TIMEOUT, transport=None):
+        self._http = httpx.AsyncClient(
+            base_url=f"{url.rstrip('/')}/rest/v1",
+            headers={'apikey': key, 'Authorization': f"Bearer {key}"},
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=timeout, transport=transport)
+        self._sem = asyncio.Semaphore(max_connections)
+
+    async def _request(self, method, table, params=None, json=None, headers=None):
+        started, outcome = time.perf_counter(), 'error'
+        try:
+            async with self._sem:
+                res = await self._http.request(method, f"/{table}", params=params, json=json, headers=headers)
+            outcome = str(res.status_code)
+            res.raise_for_status()
+            return res
+        except asyncio.CancelledError: outcome = 'cancelled'; raise
+        except httpx.TimeoutException: outcome = 'timeout'; raise
+        finally: metrics.db_seconds.observe(time.perf_counter() - started, method=method, table=table, outcome=outcome)
+
+    async def _count(self, table, params):
+        res = await self._request('HEAD', table, params={**params, 'select': 'id'}, headers={'Prefer': 'count=exact', 'Range': '0-0'})
+        total = res.headers.get('content-range', '*/0').rsplit('/', 1)[-1]
+        return int(total) if total.isdigit() else 0
+
+    async def get_profile(self, u_id):
+        res = await self._request('GET', 'profiles', params={'select': '*', 'user_id': f"eq.{u_id}", 'limit': 1})
+        rows = res.json()
+        return rows[0] if rows else None
+
+    async def upsert_profile(self, data):
+        res = await self._request('POST', 'profiles', params={'on_conflict': 'user_id'}, json=data,
+                                  headers={'Prefer': 'resolution=merge-duplicates,return=representation'})
+        rows = res.json()
+        return rows[0] if rows else None
+
+    async def set_vip(self, u_id, is_vip=True):
+        await self._request('PATCH', 'profiles', params={'user_id': f"eq.{u_id}"}, json={'is_vip': is_vip},
+                            headers={'Prefer': 'return=minimal'})
+
+    async def count_referrals(self, u_id):
+        return await self._count('profiles', {'referred_by': f"eq.{u_id}"})
+
+    async def rpc(self, name, params):
+        res = await self._request('POST', f"rpc/{name}", json=params)
+        return res.json() if res.content else None
+
+    async def insert_logs(self, rows):
+        if rows: await self._request('POST', 'logs', json=list(rows), headers={'Prefer': 'return=minimal'})
+
+    async def close(self):
+        await self._http.aclose()
+
+
+repo = Repository(SUPABASE_URL, SUPABASE_KEY) if SUPABASE_URL and SUPABASE_KEY else None
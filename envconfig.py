@@ -0,0 +1,18 @@
+import os, logging
+
+# --- خواندن تنظیمات «کلید=مقدار» از متغیرهای محیطی، مثل LLM_RPM="gpt-4o=500,dall-e-3=7" ---
+logger = logging.getLogger(__name__)
+
+
+def env_pairs(name, cast=str):
+    """Parse ``name`` from the environment as ``key=value`` pairs separated by commas.
+
+    Values go through ``cast``; entries it rejects with ``ValueError`` are
+    logged and skipped.
+    """
+    pairs = {}
+    for part in filter(None, (p.strip() for p in os.environ.get(name, "").split(','))):
+        key, _, value = part.partition('=')
+        try: pairs[key.strip()] = cast(value.strip())
+        except ValueError: logger.warning(f"Invalid {name} entry: {part}")
+    return pairs
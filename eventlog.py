@@ -0,0 +1,110 @@
+import os, json, asyncio, logging
+
+# --- ثبت رویدادها به‌صورت دسته‌ای در پس‌زمینه ---
+logger = logging.getLogger(__name__)
+
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", 200))
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", 1))
+LOG_SPOOL_PATH = os.environ.get("LOG_SPOOL_PATH")
+
+
+class LogWriter:
+    """Collects event rows on an asyncio queue and bulk-inserts them into ``logs``.
+
+    A batch is flushed once it reaches ``batch_size`` rows or ``interval``
+    seconds after its first row. When the queue is full new rows are dropped
+    and counted. Batches that fail to insert are appended to ``spool_path``
+    (JSON lines) if set, and replayed after the next successful flush.
+    """
+
+    def __init__(self, repo, max_queue=LOG_QUEUE_SIZE, batch_size=LOG_BATCH_SIZE,
+                 interval=LOG_FLUSH_INTERVAL, spool_path=LOG_SPOOL_PATH):
+        self.repo, self.batch_size, self.interval, self.spool_path = repo, batch_size, interval, spool_path
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.dropped = self.written = self.failed = self.spooled = 0
+        self._task = None
+        self._stopping = False
+
+    def log(self, row):
+        try: self.queue.put_nowait(row)
+        except asyncio.QueueFull: self.dropped += 1
+
+    def start(self):
+        if self._task is None: self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            # wait_for در پایتون ۳.۱۱ گاهی لغو را می‌بلعد؛ تا پایان واقعی تسک دوباره لغو می‌شود
+            self._stopping = True
+            while not self._task.done():
+                self._task.cancel()
+                await asyncio.wait({self._task}, timeout=0.1)
+            self._task = None
+        rows = self._drain(self.batch_size)
+        while rows:
+            await self._flush(rows)
+            rows = self._drain(self.batch_size)
+
+    def _drain(self, limit):
+        rows = []
+        while len(rows) < limit:
+            try: rows.append(self.queue.get_nowait())
+            except asyncio.QueueEmpty: break
+        return rows
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while not self._stopping:
+            rows = [await self.queue.get()]
+            deadline = loop.time() + self.interval
+            try:
+                while len(rows) < self.batch_size:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0: break
+                    try: rows.append(await asyncio.wait_for(self.queue.get(), remaining))
+                    except asyncio.TimeoutError: break
+            except asyncio.CancelledError:
+                await self._flush(rows); raise
+            await self._flush(rows)
+
+    async def _flush(self, rows):
+        try:
+            await self.repo.insert_logs(rows)
+            self.written += len(rows)
+        except Exception as e:
+            self.failed += len(rows)
+            logger.warning(f"Event log flush of {len(rows)} rows failed: {e}")
+            self._spool(rows)
+            return
+        await self._replay_spool()
+
+    def _spool(self, rows):
+        if not self.spool_path: return False
+        try:
+            with open(self.spool_path, 'a', encoding='utf-8') as f:
+                for r in rows: f.write(json.dumps(r, ensure_ascii=False) + '\n')
+        except OSError as e:
+            logger.error(f"Event log spool write failed: {e}")
+            return False
+        self.spooled += len(rows)
+        return True
+
+    async def _replay_spool(self):
+        if not self.spool_path or not os.path.exists(self.spool_path): return
+        replay_path = self.spool_path + '.replay'
+        os.replace(self.spool_path, replay_path)
+        with open(replay_path, encoding='utf-8') as f: rows = [json.loads(l) for l in f if l.strip()]
+        for i in range(0, len(rows), self.batch_size):
+            try: await self.repo.insert_logs(rows[i:i + self.batch_size])
+            except Exception as e:
+                logger.warning(f"Event log spool replay failed: {e}")
+                self.spooled -= len(rows) - i
+                self._spool(rows[i:])
+                break
+            self.written += len(rows[i:i + self.batch_size])
+        os.remove(replay_path)
+
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'written': self.written, 'dropped': self.dropped,
+                'failed': self.failed, 'spooled': self.spooled}
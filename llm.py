@@ -0,0 +1,234 @@
+import os, json, time, random, asyncio, logging
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError
+import metrics, routing
+from envconfig import env_pairs
+
+# --- درگاه غیرهمزمان OpenAI ---
+logger = logging.getLogger(__name__)
+
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", 120))
+LLM_BATCH_POLL = float(os.environ.get("LLM_BATCH_POLL", 60)) # فاصله بررسی وضعیت کارهای Batch API به ثانیه
+
+# سقف درخواست‌های همزمان برای هر مدل؛ با LLM_CONCURRENCY="gpt-4o=16,dall-e-3=4" قابل تغییر است
+DEFAULT_LIMITS = {'gpt-4o': 16, 'gpt-4o-mini': 16, 'dall-e-3': 4, 'tts-1': 8, 'whisper-1': 8}
+DEFAULT_LIMIT = 8
+
+LIMITS = {**DEFAULT_LIMITS, **env_pairs("LLM_CONCURRENCY", lambda n: max(1, int(n)))}
+
+# سقف درخواست در دقیقه برای هر مدل (سطل توکن)؛ با LLM_RPM="gpt-4o=500,dall-e-3=7" قابل تغییر است و 0 یعنی بدون سقف
+DEFAULT_RPM = {'gpt-4o': 500, 'gpt-4o-mini': 500, 'dall-e-3': 7, 'tts-1': 50, 'whisper-1': 50}
+RPM = {**DEFAULT_RPM, **env_pairs("LLM_RPM", lambda n: max(0, int(n)))}
+LLM_RETRIES = int(os.environ.get("LLM_RETRIES", 3))
+LLM_BACKOFF_BASE = float(os.environ.get("LLM_BACKOFF_BASE", 1))
+LLM_BACKOFF_MAX = float(os.environ.get("LLM_BACKOFF_MAX", 20))
+# مدل جایگزین وقتی مدل اصلی بعد از LLM_FALLBACK_RETRIES تلاش هنوز 429/5xx می‌دهد؛ با LLM_FALLBACK="gpt-4o=gpt-4o-mini" قابل تغییر است
+# و "gpt-4o=" جایگزین را خاموش می‌کند
+FALLBACK = {k: v for k, v in {'gpt-4o': 'gpt-4o-mini', **env_pairs("LLM_FALLBACK")}.items() if v}
+LLM_FALLBACK_RETRIES = int(os.environ.get("LLM_FALLBACK_RETRIES", 1))
+
+# تلاش مجدد کلاینت خاموش است تا همه تلاش‌ها از سطل توکن و متریک‌های همین ماژول بگذرند
+aclient = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0) if OPENAI_API_KEY else None
+
+
+class TokenBucket:
+    """Allows ``rate`` acquisitions per second on average with bursts of up to ``capacity``."""
+
+    def __init__(self, rate, capacity):
+        self.rate, self.capacity = rate, capacity
+        self.tokens, self.updated = capacity, time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1; return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def try_acquire(self):
+        """Take a token if one is available right now, without waiting."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1: return False
+        self.tokens -= 1; return True
+
+    def pause(self, seconds):
+        # بعد از 429 سطل خالی می‌شود تا درخواست‌های بعدی هم تا پایان مهلت صبر کنند
+        self.tokens = min(self.tokens, -seconds * self.rate)
+        self.updated = time.monotonic()
+
+
+_sems = {}
+_buckets = {}
+_inflight = {}
+
+def _sem(model):
+    if model not in _sems: _sems[model] = asyncio.Semaphore(LIMITS.get(model, DEFAULT_LIMIT))
+    return _sems[model]
+
+def _bucket(model):
+    if model not in _buckets:
+        rpm = RPM.get(model, 0)
+        _buckets[model] = TokenBucket(rpm / 60, max(1, rpm // 6)) if rpm else None
+    return _buckets[model]
+
+def _retry_delay(error, attempt):
+    """Seconds to wait before retrying ``error``, or None if it should not be retried."""
+    if isinstance(error, APIStatusError):
+        if error.status_code != 429 and error.status_code < 500: return None
+        retry_after = error.response.headers.get('retry-after')
+    elif isinstance(error, APIConnectionError): retry_after = None
+    else: return None
+    delay = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+    try: return max(delay, float(retry_after)) if retry_after else delay
+    except ValueError: return delay
+
+async def _call(model, make_coro, timeout=None, key=None, can_retry=None, retries=None):
+    """Run one OpenAI request under the model's rate limit, concurrency limit and timeout.
+
+    429, 5xx and connection errors are retried up to ``retries`` (default
+    ``LLM_RETRIES``) times with
+    jittered exponential backoff (honouring ``Retry-After``) while
+    ``can_retry()`` allows it. Requests started with a ``key`` (the user id in
+    handlers) can be aborted together through :func:`cancel`.
+    """
+    if not aclient: raise RuntimeError("OpenAI is not configured")
+    retries = LLM_RETRIES if retries is None else retries
+    async def attempt():
+        queued, exc = time.perf_counter(), None
+        try:
+            if bucket := _bucket(model): await bucket.acquire()
+            async with _sem(model):
+                metrics.openai_queue_seconds.observe(time.perf_counter() - queued, model=model)
+                metrics.openai_inflight.inc(model=model)
+                try: return await asyncio.wait_for(make_coro(), timeout or LLM_TIMEOUT)
+                finally: metrics.openai_inflight.dec(model=model)
+        except BaseException as e: exc = e; raise
+        finally: metrics.openai_seconds.observe(time.perf_counter() - queued, model=model, outcome=metrics.outcome(exc))
+    async def run():
+        for n in range(retries + 1):
+            try: return await attempt()
+            except Exception as e:
+                delay = _retry_delay(e, n) if n < retries and (can_retry is None or can_retry()) else None
+                if delay is None: raise
+                if getattr(e, 'status_code', None) == 429 and (bucket := _bucket(model)): bucket.pause(delay)
+                metrics.openai_retries.inc(model=model, reason=str(getattr(e, 'status_code', 'connection')))
+                logger.warning(f"OpenAI {model} request failed ({e.__class__.__name__}); retry {n + 1} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+    if key is None: return await run()
+    task = asyncio.ensure_future(run())
+    _inflight.setdefault(key, set()).add(task)
+    try: return await task
+    finally:
+        tasks = _inflight.get(key)
+        if tasks is not None:
+            tasks.discard(task)
+            if not tasks: _inflight.pop(key, None)
+
+def cancel(key):
+    """Cancel every in-flight request started with ``key``; returns how many were cancelled."""
+    tasks = _inflight.pop(key, set())
+    for t in tasks: t.cancel()
+    return len(tasks)
+
+async def _with_fallback(model, run, can_retry=None):
+    # مدل اصلی با تلاش مجدد کمتر؛ اگر هنوز شلوغ بود (429/5xx/اتصال) یک بار با مدل جایگزین
+    fallback = FALLBACK.get(model)
+    if not fallback: return await run(model, None)
+    try: return await run(model, LLM_FALLBACK_RETRIES)
+    except Exception as e:
+        if _retry_delay(e, 0) is None or (can_retry and not can_retry()): raise
+        metrics.openai_fallbacks.inc(model=model, fallback=fallback)
+        logger.warning(f"OpenAI {model} overloaded ({e.__class__.__name__}); falling back to {fallback}")
+        return await run(fallback, None)
+
+async def chat(messages, model=None, timeout=None, key=None, feature=None, **kw):
+    """Chat completion text; ``feature`` picks the model, output cap and input budget (see :mod:`routing`)."""
+    messages, model, kw = routing.prepare(feature, messages, model, kw)
+    async def run(model, retries):
+        res = await _call(model, lambda: aclient.chat.completions.create(model=model, messages=messages, **kw), timeout, key, retries=retries)
+        metrics.record_usage(model, res.usage)
+        choice = res.choices[0]
+        # JSON بریده‌شده با سقف max_tokens قابل استفاده نیست؛ خطا می‌دهد تا کش نشود
+        if choice.finish_reason == 'length' and (kw.get('response_format') or {}).get('type') == 'json_object':
+            raise RuntimeError(f"OpenAI {model} JSON reply was cut off at max_tokens")
+        return choice.message.content
+    return await _with_fallback(model, run)
+
+async def image(prompt, size="1024x1024", model="dall-e-3", timeout=None, key=None):
+    res = await _call(model, lambda: aclient.images.generate(model=model, prompt=prompt, size=size, n=1), timeout, key)
+    return res.data[0].url
+
+async def speech(text, voice="onyx", model="tts-1", response_format="opus", timeout=None, key=None):
+    res = await _call(model, lambda: aclient.audio.speech.create(model=model, voice=voice, input=text, response_format=response_format), timeout, key)
+    return res.content
+
+async def transcribe(file, model="whisper-1", timeout=None, key=None):
+    res = await _call(model, lambda: aclient.audio.transcriptions.create(model=model, file=file), timeout, key)
+    return res.text
+
+async def submit_batch(requests, feature=None):
+    """Start a Batch API job for ``requests`` (``(custom_id, messages, kwargs)`` tuples); returns its id."""
+    lines = []
+    for custom_id, messages, kw in requests:
+        messages, model, kw = routing.prepare(feature, messages, kw=kw)
+        lines.append(json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': '/v1/chat/completions',
+                                 'body': {'model': model, 'messages': messages, **kw}}, ensure_ascii=False))
+    upload = await _call('batch', lambda: aclient.files.create(file=('batch.jsonl', '\n'.join(lines).encode()), purpose='batch'))
+    batch = await _call('batch', lambda: aclient.batches.create(input_file_id=upload.id, endpoint='/v1/chat/completions', completion_window='24h'))
+    return batch.id
+
+async def batch_results(batch_id, poll=None):
+    """Wait for a Batch API job and return ``{custom_id: reply}`` for the requests that succeeded.
+
+    Expired or cancelled batches still yield whatever finished; a failed
+    batch raises ``RuntimeError``.
+    """
+    while True:
+        batch = await _call('batch', lambda: aclient.batches.retrieve(batch_id))
+        if batch.status == 'failed': raise RuntimeError(f"Batch {batch_id} failed")
+        if batch.status in ('completed', 'expired', 'cancelled'): break
+        await asyncio.sleep(poll or LLM_BATCH_POLL)
+    results = {}
+    if batch.output_file_id:
+        content = await _call('batch', lambda: aclient.files.content(batch.output_file_id))
+        for line in filter(None, content.text.splitlines()):
+            row = json.loads(line)
+            res = row.get('response') or {}
+            if res.get('status_code') != 200: continue
+            body = res['body']
+            usage = body.get('usage') or {}
+            metrics.openai_tokens.inc(usage.get('prompt_tokens', 0), model=body.get('model', 'batch'), kind='prompt')
+            metrics.openai_tokens.inc(usage.get('completion_tokens', 0), model=body.get('model', 'batch'), kind='completion')
+            results[row['custom_id']] = body['choices'][0]['message']['content']
+    return results
+
+async def stream_chat(messages, model=None, timeout=None, key=None, feature=None, **kw):
+    """Yield reply text pieces as they arrive.
+
+    The request runs in its own task under the same limits as :func:`chat`,
+    so a slow consumer never stalls the connection; closing the generator
+    early cancels the request.
+    """
+    messages, model, kw = routing.prepare(feature, messages, model, kw)
+    queue = asyncio.Queue()
+    emitted = False # بعد از رسیدن اولین تکه تلاش مجدد یا مدل جایگزین ممکن نیست، چون متن تکراری می‌شد
+    async def run(model, retries):
+        async def produce():
+            nonlocal emitted
+            stream = await aclient.chat.completions.create(model=model, messages=messages, stream=True, stream_options={"include_usage": True}, **kw)
+            async for chunk in stream:
+                if chunk.usage: metrics.record_usage(model, chunk.usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    emitted = True; queue.put_nowait(chunk.choices[0].delta.content)
+        return await _call(model, produce, timeout, key, can_retry=lambda: not emitted, retries=retries)
+    task = asyncio.ensure_future(_with_fallback(model, run, can_retry=lambda: not emitted))
+    task.add_done_callback(lambda _: queue.put_nowait(None))
+    try:
+        while (piece := await queue.get()) is not None: yield piece
+        task.result()
+    finally:
+        if not task.done(): task.cancel()
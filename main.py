@@ -1,10 +1,21 @@
-import os, logging, threading, json, asyncio, base64, math
-from datetime import datetime, timezone
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from openai import OpenAI
-from supabase import create_client, Client
+import os, io, logging, json, asyncio, base64, math, tempfile, hmac, signal, secrets
+import httpx
+import llm, metrics, routing, vision
+from db import repo
+from cache import TTLCache
+from eventlog import LogWriter
+from respcache import ResponseCache
+from artifacts import ArtifactCache, artifact_key
+from server import HttpServer
+from persistence import SQLitePersistence
+from shard import Front, WORKER_BASE_PORT
+from audio import split_text, merge_ogg_opus
+from quota import create_ledger, Unlimited
+from scheduler import Scheduler, SingleFlight
+from bulk import BulkStore, BULK_CONCURRENCY, BULK_MAX_ITEMS, BULK_BATCH
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
 from telegram.constants import ChatAction
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler,
     filters, ConversationHandler, CallbackQueryHandler)
 
@@ -14,9 +25,30 @@ logger = logging.getLogger(__name__)
 
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
 ADMIN_ID = os.environ.get("ADMIN_ID")
+BOT_MODE = os.environ.get("BOT_MODE", "polling") # polling یا webhook
+HOST = os.environ.get("HOST", "0.0.0.0")
+PORT = int(os.environ.get("PORT", 8080))
+WORKERS = int(os.environ.get("WORKERS", 1)) # بیش از ۱: پروسه جلویی آپدیت‌ها را بین ورکرها تقسیم می‌کند (فقط وب‌هوک)
+WORKER_INDEX, WORKER_COUNT = int(os.environ.get("WORKER_INDEX", 0)), int(os.environ.get("WORKER_COUNT", 1)) # پروسه جلویی برای هر ورکر تنظیم می‌کند
+PERSISTENCE_PATH = os.environ.get("PERSISTENCE_PATH") # فایل SQLite برای وضعیت گفتگوها و user_data
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL") # آدرس عمومی سرویس؛ اگر خالی باشد وب‌هوک ثبت نمی‌شود (اجرای محلی)
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+# وب‌هوک ثبت‌شده بدون توکن محرمانه آپدیت جعلی هم می‌پذیرد؛ اگر تنظیم نشده باشد یک توکن تصادفی ساخته و همان ثبت می‌شود
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or (secrets.token_urlsafe(32) if WEBHOOK_URL else None)
+TELEGRAM_BASE_URL = os.environ.get("TELEGRAM_BASE_URL") # سرور Bot API جایگزین (مثلاً سرور محلی یا شبیه‌ساز بنچمارک)
+
+STREAM_REPLIES = os.environ.get("STREAM_REPLIES", "1") != "0"
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", 1.5)) # فاصله ویرایش پیام در حالت استریم (محدودیت تلگرام)
+STREAM_EDIT_RATE = float(os.environ.get("STREAM_EDIT_RATE", 20)) # سقف ویرایش‌های پیش‌نمایش در ثانیه برای کل ربات (تلگرام حدود ۳۰ پیام در ثانیه)
+STREAM_FINAL_RETRIES = 5
+MAX_MESSAGE_LEN = 4096
+TTS_CHUNK_CHARS = int(os.environ.get("TTS_CHUNK_CHARS", 800))
+TTS_PREVIEW_CHARS = int(os.environ.get("TTS_PREVIEW_CHARS", 250)) # 0 یعنی بدون ارسال پیش‌نمایش
+TTS_WORKERS = int(os.environ.get("TTS_WORKERS", 4))
+SPECULATE = os.environ.get("SPECULATE", "vip") # off | vip | all — نگارش پیش‌دستانه هر سه سناریو پس از تولید ایده‌ها
+SPECULATION_TTL = float(os.environ.get("SPECULATION_TTL", 600))
+MEDIA_MEMORY_LIMIT = int(os.environ.get("MEDIA_MEMORY_LIMIT", 20 * 1024 * 1024)) # فایل‌های بزرگ‌تر به فایل موقت منتقل می‌شوند
 
 DAILY_LIMIT, REFERRAL_REWARD = 5, 3 #
 CARD_NUMBER, CARD_NAME = "6118-2800-5587-6343", "امیراحمد شاه حسینی"
@@ -27,73 +59,302 @@ LOGO_STYLES_PROMPTS = {
     'ls_emblem': 'Emblem style badge, bold lines, vintage seal concept, strong and assertive.'
 }
 
-client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY) if SUPABASE_URL and SUPABASE_KEY else None
+# کش وضعیت VIP و سهمیه دعوت هر کاربر
+entitlements = TTLCache(maxsize=int(os.environ.get("ENTITLEMENT_CACHE_SIZE", 10000)), ttl=float(os.environ.get("ENTITLEMENT_CACHE_TTL", 300)))
+# کش پروفایل‌ها؛ None یعنی کاربر پروفایل ندارد (کش منفی با عمر کوتاه‌تر)
+profiles = TTLCache(maxsize=int(os.environ.get("PROFILE_CACHE_SIZE", 10000)), ttl=float(os.environ.get("PROFILE_CACHE_TTL", 600)))
+PROFILE_NEGATIVE_TTL = float(os.environ.get("PROFILE_NEGATIVE_TTL", 60))
+_NO_ENTRY = object()
+event_log = LogWriter(repo) if repo else None
+response_cache = ResponseCache()
+# file_id لوگو، کاور و ویس‌های ساخته‌شده برای ارسال دوباره بدون تولید و آپلود
+artifacts = ArtifactCache()
+ARTIFACT_SENDERS = {'logo': ('send_photo', 'photo'), 'cover': ('send_photo', 'photo'), 'tts': ('send_voice', 'voice')}
+# سهمیه روزانه در دفتر جداگانه شمرده می‌شود؛ جدول logs فقط برای آمار است
+quota = create_ledger(repo)
+# همه کارهای تولیدی (OpenAI) از این صف پذیرش می‌گذرند
+scheduler = Scheduler()
+# لوگو، کاور و ویس‌هایی که همین حالا برای همان کاربر و همان ورودی در حال ساخت‌اند
+flights = SingleFlight()
+# کارهای تقویم محتوا و پیشرفت هر مورد؛ تسک‌های در حال اجرا بر اساس شناسه کار
+bulk_store = BulkStore()
+bulk_tasks = {}
 
 # وضعیت‌های گفتگو
 (P_BUSINESS, P_GOAL, P_AUDIENCE, P_TONE, 
  C_TEXT, C_CLAIM, C_EMOTION, EXPAND, 
  H_TOPIC, SPY_TEXT, 
- LOG_MODE, LOGO_STYLE_SELECT, LOGO_CUSTOM_PROMPT) = range(13)
-
-# --- سرور فیک برای زنده نگه داشتن Render ---
-class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b"Bot is Running...")
-def run_fake_server():
-    port = int(os.environ.get("PORT", 8080))
-    HTTPServer(('0.0.0.0', port), SimpleHTTPRequestHandler).serve_forever()
-threading.Thread(target=run_fake_server, daemon=True).start()
+ LOG_MODE, LOGO_STYLE_SELECT, LOGO_CUSTOM_PROMPT,
+ BULK_INPUT) = range(14)
+
+# --- سرور HTTP روی PORT (بررسی سلامت Render و دریافت وب‌هوک) ---
+http_server = HttpServer()
+async def health(request): return 200, b"Bot is Running...", 'text/plain'
+http_server.route('GET', '/', health)
+http_server.route('GET', '/health', health)
+http_server.route('GET', '/metrics', metrics.handle_metrics)
+
+def add_webhook_route(app):
+    async def webhook(request):
+        token = request.headers.get('x-telegram-bot-api-secret-token', '')
+        if WEBHOOK_SECRET and not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()): return 403, b'', 'text/plain'
+        try: update = Update.de_json(json.loads(request.body), app.bot)
+        except ValueError: return 400, b'', 'text/plain'
+        await app.update_queue.put(update)
+        return 200, b'', 'text/plain'
+    http_server.route('POST', WEBHOOK_PATH, webhook)
+
+# کش دسترسی و پروفایل هر کاربر روی ورکری است که آپدیت‌های او را می‌گیرد؛ تغییر از ورکر دیگر (مثل تایید VIP توسط ادمین) به آن خبر داده می‌شود
+INVALIDATE_PATH = '/internal/invalidate'
+
+async def invalidate_user(u_id):
+    u_id = str(u_id); entitlements.pop(u_id); profiles.pop(u_id)
+    owner = int(u_id) % WORKER_COUNT
+    if owner == WORKER_INDEX: return
+    headers = {'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET} if WEBHOOK_SECRET else {}
+    try:
+        async with httpx.AsyncClient(timeout=5) as client:
+            res = await client.post(f"http://127.0.0.1:{WORKER_BASE_PORT + owner}{INVALIDATE_PATH}", content=json.dumps({'user_id': u_id}), headers=headers)
+            res.raise_for_status()
+    except httpx.HTTPError as e: logger.warning(f"Cache invalidation for {u_id} on worker {owner} failed: {e}")
+
+async def invalidate(request):
+    token = request.headers.get('x-telegram-bot-api-secret-token', '')
+    if WEBHOOK_SECRET and not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()): return 403, b'', 'text/plain'
+    try: u_id = str(json.loads(request.body)['user_id'])
+    except (ValueError, KeyError): return 400, b'', 'text/plain'
+    entitlements.pop(u_id); profiles.pop(u_id)
+    return 200, b'', 'text/plain'
+if WORKER_COUNT > 1: http_server.route('POST', INVALIDATE_PATH, invalidate)
+
+# مقادیری که فقط هنگام خواندن /metrics به‌روز می‌شوند
+@metrics.registry.collector
+def collect_state():
+    for name, c in (('entitlements', entitlements), ('profiles', profiles), ('responses', response_cache), ('artifacts', artifacts)):
+        st = c.stats()
+        if 'size' in st: metrics.cache_entries.set(st['size'], cache=name)
+        metrics.cache_requests.set(st['hits'], cache=name, result='hit')
+        metrics.cache_requests.set(st['misses'], cache=name, result='miss')
+    if event_log:
+        st = event_log.stats()
+        metrics.queue_depth.set(st['queued'], queue='eventlog')
+        for k in ('written', 'dropped', 'failed', 'spooled'): metrics.eventlog_rows.set(st[k], result=k)
+    metrics.queue_depth.set(len(speculations), queue='speculations')
+    metrics.queue_depth.set(len(scheduler.lanes[True]), queue='admission_vip')
+    metrics.queue_depth.set(len(scheduler.lanes[False]), queue='admission_regular')
+    metrics.queue_depth.set(scheduler.running, queue='admission_running')
+    metrics.queue_depth.set(len(bulk_tasks), queue='bulk_jobs')
+    metrics.queue_depth.set(len(flights), queue='flights')
+
+def instrument(app):
+    # همه هندلرها (از جمله داخل ConversationHandlerها) با زمان‌سنج پوشانده می‌شوند
+    def wrap(handlers):
+        for h in handlers:
+            if isinstance(h, ConversationHandler):
+                wrap(h.entry_points); wrap(h.fallbacks)
+                for state in h.states.values(): wrap(state)
+            else: h.callback = metrics.timed_handler(h.callback)
+    for group in app.handlers.values(): wrap(group)
+    @metrics.registry.collector
+    def collect_updates():
+        metrics.queue_depth.set(app.update_queue.qsize(), queue='updates')
+        metrics.queue_depth.set(app.update_processor.current_concurrent_updates, queue='updates_in_progress')
 
 # --- توابع کمکی ---
 def is_admin(u_id): return ADMIN_ID and str(u_id) == str(ADMIN_ID)
 
+async def get_profile(u_id):
+    u_id = str(u_id)
+    p = profiles.get(u_id, _NO_ENTRY)
+    if p is _NO_ENTRY:
+        p = await repo.get_profile(u_id)
+        profiles.set(u_id, p, ttl=None if p else PROFILE_NEGATIVE_TTL)
+    return p
+
+async def save_profile(data):
+    p = await repo.upsert_profile(data)
+    if p: profiles.set(str(p['user_id']), p)
+    else: profiles.pop(str(data['user_id']))
+    return p
+
+async def get_entitlement(u_id):
+    u_id = str(u_id)
+    ent = entitlements.get(u_id)
+    if ent is None:
+        p, ref_count = await asyncio.gather(get_profile(u_id), repo.count_referrals(u_id))
+        ent = {'vip': bool(p and p.get('is_vip')), 'allowance': DAILY_LIMIT + (ref_count * REFERRAL_REWARD)}
+        entitlements.set(u_id, ent)
+    return ent
+
 async def is_user_vip(u_id):
-    if not supabase: return False
-    try:
-        res = supabase.table('profiles').select('is_vip').eq('user_id', str(u_id)).execute()
-        return res.data[0]['is_vip'] if res.data else False
+    if not repo: return False
+    try: return (await get_entitlement(u_id))['vip']
     except: return False
 
 async def get_user_allowance(u_id):
-    try:
-        ref_count = supabase.table('profiles').select("id", count="exact").eq('referred_by', str(u_id)).execute().count or 0
-        return DAILY_LIMIT + (ref_count * REFERRAL_REWARD)
+    try: return (await get_entitlement(u_id))['allowance']
     except: return DAILY_LIMIT
 
+async def quota_exhausted(update, usage, allowance):
+    kb = [[InlineKeyboardButton("🎁 دریافت سهمیه", callback_data='menu_referral')], [InlineKeyboardButton("💎 ارتقا به VIP", callback_data='menu_upgrade_vip')]]
+    msg = f"⚠️ سهمیه امروز تمام شد ({usage}/{allowance})."
+    target = update.message if update.message else update.callback_query.message
+    await target.reply_text(msg, reply_markup=InlineKeyboardMarkup(kb))
+
 async def check_daily_limit(update, u_id):
+    # فقط بررسی؛ برای شروع گفتگوهایی که مصرف واقعی در مراحل بعد رزرو می‌شود
     if is_admin(u_id) or await is_user_vip(u_id): return True
     try:
-        today = datetime.now(timezone.utc).date().isoformat()
-        usage = supabase.table('logs').select("id", count="exact").in_('event_type', ['ideas_generated', 'hashtags_generated_success', 'coach_analyzed_success', 'dalle_generated', 'vip_tts_generated']).gte('created_at', f"{today}T00:00:00Z").eq('user_id', str(u_id)).execute().count or 0
-        allowance = await get_user_allowance(u_id)
+        usage, allowance = await asyncio.gather(quota.usage(u_id), get_user_allowance(u_id))
         if usage >= allowance:
-            kb = [[InlineKeyboardButton("🎁 دریافت سهمیه", callback_data='menu_referral')], [InlineKeyboardButton("💎 ارتقا به VIP", callback_data='menu_upgrade_vip')]]
-            msg = f"⚠️ سهمیه امروز تمام شد ({usage}/{allowance})."
-            target = update.message if update.message else update.callback_query.message
-            await target.reply_text(msg, reply_markup=InlineKeyboardMarkup(kb))
-            return False
+            await quota_exhausted(update, usage, allowance); return False
         return True
     except: return True
 
+async def reserve_quota(update, u_id):
+    # یک واحد سهمیه را پیش از فراخوانی OpenAI رزرو می‌کند؛ در صورت اتمام سهمیه None برمی‌گرداند
+    if is_admin(u_id) or await is_user_vip(u_id): return Unlimited()
+    allowance = await get_user_allowance(u_id)
+    try: reservation, usage = await quota.reserve(u_id, allowance)
+    except Exception as e:
+        logger.warning(f"Quota reservation for {u_id} failed: {e}"); return Unlimited()
+    if reservation is None: await quota_exhausted(update, usage, allowance)
+    return reservation
+
+async def claim_job(update, feature):
+    # هر کاربر در هر بخش فقط یک کار در حال اجرا یا در صف دارد؛ VIP و ادمین در صف اولویت‌دار
+    uid = update.effective_user.id
+    job = scheduler.claim(uid, feature, priority=bool(is_admin(uid)) or await is_user_vip(uid))
+    if job is None:
+        target = update.message if update.message else update.callback_query.message
+        await target.reply_text("⏳ درخواست قبلی شما در همین بخش هنوز در حال انجام است.")
+    return job
+
+async def admit(job, wait):
+    # وقتی ظرفیت پر است نوبت کاربر در صف روی همان پیام انتظار نشان داده می‌شود
+    text, shown = wait.text, False
+    async def show(pos):
+        nonlocal shown
+        await wait.edit_text(f"{text}\n\n👥 نوبت شما در صف: {pos}"); shown = True
+    await job.admit(show)
+    if shown:
+        try: await wait.edit_text(text)
+        except (BadRequest, RetryAfter): pass
+
+async def claim_flight(query, action, digest):
+    # دکمه‌ای که تا پایان ساخت همان ورودی دوباره زده شود فقط یک اعلان کوتاه می‌گیرد و کار تازه‌ای شروع نمی‌کند
+    flight = flights.claim((str(query.from_user.id), action, digest))
+    if flight is None:
+        metrics.duplicate_requests.inc(action=action)
+        await query.answer("⏳ همین درخواست در حال انجام است؛ نتیجه همین‌جا ارسال می‌شود.")
+    else: await query.answer()
+    return flight
+
+async def send_artifact(bot, chat_id, key, kind, media, **kw):
+    # فایل با دکمه «ارسال دوباره» فرستاده می‌شود و file_id تلگرام برمی‌گردد
+    method, field = ARTIFACT_SENDERS[kind]
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔁 ارسال دوباره", callback_data=f"again_{key}")]])
+    msg = await getattr(bot, method)(chat_id=chat_id, reply_markup=kb, **{field: media}, **kw)
+    return msg.photo[-1].file_id if msg.photo else msg.voice.file_id
+
+async def resend_artifact(bot, chat_id, key, **kw):
+    # نسخه ذخیره‌شده را بدون تولید و آپلود دوباره می‌فرستد؛ اگر نباشد False برمی‌گرداند
+    entry = await artifacts.get(key)
+    if not entry: return False
+    try: await send_artifact(bot, chat_id, key, entry['kind'], entry['file_id'], **kw)
+    except BadRequest:
+        # file_id دیگر معتبر نیست؛ از فایل روی دیسک (اگر نگه داشته شده) دوباره آپلود می‌شود
+        data = await artifacts.read(entry)
+        if data is None:
+            await artifacts.drop(key); return False
+        await artifacts.put(key, entry['kind'], await send_artifact(bot, chat_id, key, entry['kind'], data, **kw))
+    return True
+
 def log_event(u_id, e_type, content=""):
-    try: supabase.table('logs').insert({'user_id': str(u_id), 'event_type': e_type, 'content': content}).execute()
-    except: pass
+    if event_log: event_log.log({'user_id': str(u_id), 'event_type': e_type, 'content': content})
+
+async def cached_chat(feature, prompt, key=None, parse=None, **kw):
+    # پاسخ کش‌شده هم مثل تولید جدید از سهمیه روزانه کم می‌شود؛ هندلرها رویداد را یکسان ثبت می‌کنند
+    # پاسخ فقط وقتی کش می‌شود که خالی نباشد و parse (اگر داده شده) خطا ندهد؛ خروجی parse برگردانده می‌شود
+    parse = parse or (lambda reply: reply)
+    model = kw.pop('model', None) or routing.route(feature)[0]
+    reply = await response_cache.get(feature, model, prompt)
+    if reply is not None:
+        try: return parse(reply)
+        except (ValueError, KeyError, TypeError): pass
+    reply = await llm.chat(prompt, model=model, key=key, feature=feature, **kw)
+    result = parse(reply)
+    if reply and reply.strip(): await response_cache.set(feature, model, prompt, reply)
+    return result
+
+# بودجه مشترک ویرایش‌های پیش‌نمایش همه پیام‌ها؛ وقتی تمام شود پیش‌نمایش‌ها جا می‌افتند و فقط ویرایش نهایی فرستاده می‌شود
+stream_edits = llm.TokenBucket(STREAM_EDIT_RATE, STREAM_EDIT_RATE)
+
+async def stream_reply(wait, pieces, reply_markup=None):
+    # تکه‌ها جمع می‌شوند و پیام حداکثر هر STREAM_EDIT_INTERVAL ثانیه یک‌بار ویرایش می‌شود
+    loop = asyncio.get_running_loop()
+    text, shown, next_edit = '', '', loop.time() + STREAM_EDIT_INTERVAL / 2
+    blocked_until = 0 # پایان مهلت RetryAfter تلگرام
+    async for piece in pieces:
+        text += piece
+        preview = text.replace('*', '').strip()[:MAX_MESSAGE_LEN - 2]
+        if loop.time() < next_edit or not preview or preview == shown or not stream_edits.try_acquire(): continue
+        try: await wait.edit_text(preview + " ▌"); shown = preview
+        except RetryAfter as e: next_edit = blocked_until = loop.time() + e.retry_after; continue
+        except BadRequest: pass
+        next_edit = loop.time() + STREAM_EDIT_INTERVAL
+    # ویرایش نهایی (متن کامل و دکمه‌ها) جا نمی‌افتد: بعد از مهلت تلگرام دوباره تلاش می‌شود
+    final = text.replace('*', '')[:MAX_MESSAGE_LEN]
+    for attempt in range(STREAM_FINAL_RETRIES):
+        await asyncio.sleep(max(0, blocked_until - loop.time()))
+        try: await wait.edit_text(final, reply_markup=reply_markup); break
+        except RetryAfter as e:
+            if attempt == STREAM_FINAL_RETRIES - 1: raise
+            blocked_until = loop.time() + e.retry_after
+    return text
+
+async def answer(wait, prompt, feature=None, key=None, reply_markup=None, cache=True):
+    # پاسخ متنی را (در صورت فعال بودن به‌صورت استریم) در پیام انتظار می‌نویسد و متن پاک‌شده را برمی‌گرداند
+    # feature مدل و سقف توکن را تعیین می‌کند و اگر cache خاموش نباشد پاسخ هم کش می‌شود
+    model, cache = routing.route(feature)[0], cache and feature
+    reply = await response_cache.get(feature, model, prompt) if cache else None
+    if reply is not None:
+        await wait.edit_text(reply.replace('*', '')[:MAX_MESSAGE_LEN], reply_markup=reply_markup)
+    elif STREAM_REPLIES:
+        reply = await stream_reply(wait, llm.stream_chat(prompt, model=model, key=key, feature=feature), reply_markup)
+    else:
+        reply = await llm.chat(prompt, model=model, key=key, feature=feature)
+        await wait.edit_text(reply.replace('*', '')[:MAX_MESSAGE_LEN], reply_markup=reply_markup)
+    if cache and reply.strip(): await response_cache.set(feature, model, prompt, reply)
+    return reply.replace('*', '')
+
+async def download_media(bot, file_id):
+    # فایل در حافظه دانلود می‌شود؛ اگر از سقف بزرگ‌تر باشد در یک فایل موقت یکتا که خودکار پاک می‌شود
+    file = await bot.get_file(file_id)
+    buf = io.BytesIO() if (file.file_size or 0) <= MEDIA_MEMORY_LIMIT else tempfile.SpooledTemporaryFile(max_size=MEDIA_MEMORY_LIMIT)
+    await file.download_to_memory(buf); buf.seek(0)
+    return buf
 
 async def process_voice(update, context):
     wait = await update.message.reply_text("🎙 در حال پردازش صدا...")
-    file = await context.bot.get_file(update.message.voice.file_id)
-    path = f"v_{update.effective_user.id}.ogg"
-    await file.download_to_drive(path)
-    with open(path, "rb") as f: trans = client.audio.transcriptions.create(model="whisper-1", file=f)
-    if os.path.exists(path): os.remove(path)
+    with await download_media(context.bot, update.message.voice.file_id) as buf:
+        text = await llm.transcribe(("voice.ogg", buf), key=update.effective_user.id)
     await wait.delete()
-    return trans.text
-
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file: return base64.b64encode(image_file.read()).decode('utf-8')
+    return text
+
+async def prepare_image(bot, sizes):
+    # کوچک‌ترین اندازه کافی دانلود و در صورت امکان کوچک و فشرده می‌شود؛ آدرس data و سطح جزئیات برمی‌گردد
+    photo, largest = vision.pick_photo(sizes), max(sizes, key=lambda p: p.width * p.height)
+    with await download_media(bot, photo.file_id) as buf: data = buf.read()
+    width, height = photo.width, photo.height
+    shrunk = await asyncio.to_thread(vision.shrink, data)
+    if shrunk and len(shrunk[0]) < len(data): data, width, height = shrunk
+    detail = vision.choose_detail(width, height)
+    metrics.vision_bytes.inc(largest.file_size or len(data), kind='original')
+    metrics.vision_bytes.inc(len(data), kind='sent')
+    metrics.vision_tokens.inc(vision.image_tokens(largest.width, largest.height), kind='original')
+    metrics.vision_tokens.inc(vision.image_tokens(width, height, detail), kind='sent')
+    return f"data:image/jpeg;base64,{base64.b64encode(data).decode('utf-8')}", detail
 
 # --- بخش پروفایل ---
 async def profile_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -104,9 +365,8 @@ async def profile_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         await query.edit_message_text("بسیار خب، اطلاعات جدید را وارد کنید.\n\n۱/۴ - موضوع اصلی پیج شما چیست؟")
         return P_BUSINESS
     if query: await query.answer()
-    res = supabase.table('profiles').select("*").eq('user_id', u_id).execute()
-    if res.data:
-        p = res.data[0]
+    p = await get_profile(u_id)
+    if p:
         msg = f"👤 **پروفایل فعلی شما:**\n\n🏢 موضوع: {p['business']}\n🎯 هدف: {p['goal']}\n👥 مخاطب: {p['audience']}\n🗣 لحن: {p['tone']}\n\nآیا قصد ویرایش دارید؟"
         kb = [[InlineKeyboardButton("📝 ویرایش پروفایل", callback_data='re_edit_profile')], [InlineKeyboardButton("🔙 بازگشت به منو", callback_data='cancel')]]
         target = query.message if query else update.message
@@ -140,7 +400,7 @@ async def get_tone_and_save(update, context):
     u_id = str(update.effective_user.id)
     data = {'user_id': u_id, 'business': context.user_data['business'], 'goal': context.user_data['goal'], 'audience': context.user_data['audience'], 'tone': query.data}
     try:
-        supabase.table('profiles').upsert(data, on_conflict='user_id').execute()
+        await save_profile(data)
         await query.edit_message_text("✅ پروفایل با موفقیت ذخیره/بروزرسانی شد! 🚀")
         await show_main_menu(update, context)
     except: await query.edit_message_text("❌ خطا در ذخیره.")
@@ -196,14 +456,14 @@ async def logo_mode_handle(update, context):
         else:
             u_id = str(update.effective_user.id)
 
-            prof = supabase.table('profiles').select("*").eq('user_id', u_id).execute()
+            prof = await get_profile(u_id)
 
-            if not prof.data:
+            if not prof:
                 await query.edit_message_text("❌ ابتدا پروفایل بسازید.")
                 return ConversationHandler.END
 
-            business = prof.data[0].get('business', '')
-            audience = prof.data[0].get('audience', '')
+            business = prof.get('business', '')
+            audience = prof.get('audience', '')
 
             context.user_data['logo_topic'] = f"Business: {business}, Audience: {audience}"
 
@@ -255,49 +515,65 @@ async def get_custom_logo_topic(update, context):
 
 async def generate_logo_final(update, context):
     query = update.callback_query
-    await query.answer()
+
+    style_key = query.data
+    topic = context.user_data.get('logo_topic', 'Modern Business')
+
+    style_prompt = LOGO_STYLES_PROMPTS.get(
+        style_key,
+        LOGO_STYLES_PROMPTS['ls_minimal']
+    )
+
+    dalle_prompt = (
+        f"Professional logo ICON ONLY. NO TEXT. "
+        f"Subject: {topic}. "
+        f"Style: {style_prompt}. "
+        f"Vector art, clean design, solid background, high quality, centered composition."
+    )
+
+    artifact = artifact_key('logo', dalle_prompt)
+    flight = await claim_flight(query, 'logo', artifact)
+    if not flight:
+        return ConversationHandler.END
+
+    job = await claim_job(update, 'logo')
+    if not job:
+        flight.done()
+        return ConversationHandler.END
 
     wait = None
 
     try:
-        style_key = query.data
-        topic = context.user_data.get('logo_topic', 'Modern Business')
-
-        style_prompt = LOGO_STYLES_PROMPTS.get(
-            style_key,
-            LOGO_STYLES_PROMPTS['ls_minimal']
-        )
+        if await resend_artifact(context.bot, update.effective_chat.id, artifact, caption="🎨 لوگوی درخواستی آماده شد!"):
+            log_event(str(update.effective_user.id), 'vip_logo_reused', topic[:50])
+            return ConversationHandler.END
 
         wait = await query.message.reply_text("🎨 در حال طراحی لوگو... لطفاً کمی صبر کنید.")
-
-        dalle_prompt = (
-            f"Professional logo ICON ONLY. NO TEXT. "
-            f"Subject: {topic}. "
-            f"Style: {style_prompt}. "
-            f"Vector art, clean design, solid background, high quality, centered composition."
-        )
+        await admit(job, wait)
 
         logging.info(f"Generating logo for user {update.effective_user.id}")
         logging.info(f"Logo prompt: {dalle_prompt}")
 
-        res = client.images.generate(
-            model="dall-e-3",
-            prompt=dalle_prompt,
+        image_url = await llm.image(
+            dalle_prompt,
             size="1024x1024",
-            n=1
+            key=update.effective_user.id
         )
 
-        image_url = res.data[0].url
-
-        await context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=image_url,
+        file_id = await send_artifact(
+            context.bot,
+            update.effective_chat.id,
+            artifact,
+            'logo',
+            image_url,
             caption="🎨 لوگوی درخواستی آماده شد!"
         )
 
         if wait:
             await wait.delete()
 
+        await artifacts.put(artifact, 'logo', file_id, url=image_url)
+
         log_event(
             str(update.effective_user.id),
             'vip_logo_generated',
@@ -319,6 +595,10 @@ async def generate_logo_final(update, context):
             await query.message.reply_text("❌ خطا در تولید لوگو.")
 
         return ConversationHandler.END
+
+    finally:
+        flight.done()
+        job.done()
             
 # --- مربی و آنالیزور ---
 async def coach_start(update, context):
@@ -326,37 +606,44 @@ async def coach_start(update, context):
     return C_TEXT
 async def coach_analyze(update, context):
     u_id = str(update.effective_user.id)
-    if update.message.photo:
-        if not await is_user_vip(u_id) and not is_admin(u_id):
-            await update.message.reply_text("🔒 مخصوص VIP است."); return ConversationHandler.END
-        wait = await update.message.reply_text("👁 تحلیل گرافیک...")
+    if update.message.photo and not await is_user_vip(u_id) and not is_admin(u_id):
+        await update.message.reply_text("🔒 مخصوص VIP است."); return ConversationHandler.END
+    job = await claim_job(update, 'coach')
+    if not job: return ConversationHandler.END
+    with job:
+        if update.message.photo:
+            wait = await update.message.reply_text("👁 تحلیل گرافیک...")
+            try:
+                await admit(job, wait)
+                url, detail = await prepare_image(context.bot, update.message.photo)
+                reply = await llm.chat([{"role": "user", "content": [{"type": "text", "text": "نقد گرافیک کاور اینستاگرام (بدون ستاره)"}, {"type": "image_url", "image_url": {"url": url, "detail": detail}}]}], key=update.effective_user.id, feature='vision')
+                await wait.edit_text(reply.replace('*', ''))
+                log_event(u_id, 'coach_vision_success')
+            except: await wait.edit_text("❌ خطا.")
+            return ConversationHandler.END
+        reservation = await reserve_quota(update, u_id)
+        if not reservation: return ConversationHandler.END
+        wait = None
         try:
-            file_path = f"c_{u_id}.jpg"
-            file = await context.bot.get_file(update.message.photo[-1].file_id); await file.download_to_drive(file_path)
-            base64_img = encode_image(file_path)
-            res = client.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": [{"type": "text", "text": "نقد گرافیک کاور اینستاگرام (بدون ستاره)"}, {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_img}"}}]}])
-            os.remove(file_path); await wait.edit_text(res.choices[0].message.content.replace('*', ''))
-            log_event(u_id, 'coach_vision_success')
-        except: await wait.edit_text("❌ خطا.")
-        return ConversationHandler.END
-    if not await check_daily_limit(update, u_id): return ConversationHandler.END
-    content = await process_voice(update, context) if update.message.voice else update.message.text
-    wait = await update.message.reply_text("🧐 در حال کالبدشکافی...")
-    try:
-        res = client.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": f"نقد ایده ریلز: {content}"}])
-        await wait.edit_text(res.choices[0].message.content.replace('*', ''))
-        log_event(u_id, 'coach_analyzed_success', content[:50])
-    except: await wait.edit_text("❌ خطا.")
+            content = await process_voice(update, context) if update.message.voice else update.message.text
+            wait = await update.message.reply_text("🧐 در حال کالبدشکافی...")
+            await admit(job, wait)
+            await answer(wait, f"نقد ایده ریلز: {content}", feature='coach', key=update.effective_user.id, cache=False)
+            await reservation.commit(); log_event(u_id, 'coach_analyzed_success', content[:50])
+        except:
+            await reservation.refund()
+            if wait: await wait.edit_text("❌ خطا.")
+            else: await update.message.reply_text("❌ خطا.")
     return ConversationHandler.END
 
 # --- سناریوساز اصلی ---
 async def scenario_init(update, context):
     u_id = str(update.effective_user.id)
     if not await check_daily_limit(update, u_id): return ConversationHandler.END
-    prof = supabase.table('profiles').select("*").eq('user_id', u_id).execute()
-    if not prof.data:
+    prof = await get_profile(u_id)
+    if not prof:
         await update.message.reply_text("❌ ابتدا پروفایل بسازید."); return ConversationHandler.END
-    context.user_data['profile'] = prof.data[0]
+    context.user_data['profile'] = prof
     await update.message.reply_text("🎯 موضوع یا ادعای جنجالی خود را بفرستید:")
     return C_CLAIM
 async def get_claim(update, context):
@@ -364,73 +651,330 @@ async def get_claim(update, context):
     kb = [[InlineKeyboardButton("هشدار دهنده ⚠️", callback_data='emo_warn')], [InlineKeyboardButton("تخصصی 🧠", callback_data='emo_expert')]]
     await update.message.reply_text("🎭 حس ویدیو؟", reply_markup=InlineKeyboardMarkup(kb))
     return C_EMOTION
+def parse_ideas(reply):
+    ideas = json.loads(reply)['ideas']
+    if not ideas or not all(isinstance(i, dict) and i.get('type') and i.get('title') for i in ideas): raise ValueError("No usable ideas in reply")
+    return ideas
+def ideas_prompt(profile, claim):
+    return f"3 Reels ideas for {profile['business']} based on '{claim}'. Return JSON: {{'ideas': [{{'type': '...', 'title': '...', 'hook': '...'}}]}}"
+def script_prompt(idea, claim):
+    return f"Write a 20s Reels script. Topic: {idea['title']}, Claim: {claim}. No 'hello', no 'like/comment'. Focus on hook. Persian language."
+
+# سناریوهای پیش‌دستانه هر کاربر: {'ideas': [...], 'jobs': [...], 'tasks': [...], 'timer': ...}
+speculations = {}
+
+def drop_speculation(uid):
+    spec = speculations.pop(uid, None)
+    if spec:
+        spec['timer'].cancel()
+        for t in spec['tasks']: t.cancel()
+        for job in spec['jobs']:
+            if job: job.done()
+
+async def speculate(uid, ideas, claim):
+    if SPECULATE == 'off' or (SPECULATE == 'vip' and not (is_admin(uid) or await is_user_vip(uid))): return
+    drop_speculation(uid)
+    # سناریوی پیش‌دستانه هم از صف پذیرش می‌گذرد، ولی همیشه در صف عادی تا جای کار درخواست‌شده را نگیرد
+    jobs = [scheduler.claim(uid, f'speculation_{i}') for i in range(len(ideas))]
+    tasks = [asyncio.create_task(speculative_script(job, uid, idea, claim)) for job, idea in zip(jobs, ideas)]
+    for t, job in zip(tasks, jobs):
+        if job: t.add_done_callback(lambda _, job=job: job.done())
+        t.add_done_callback(lambda t: t.cancelled() or t.exception())
+    timer = asyncio.get_running_loop().call_later(SPECULATION_TTL, drop_speculation, uid)
+    speculations[uid] = {'ideas': ideas, 'jobs': jobs, 'tasks': tasks, 'timer': timer}
+
+async def speculative_script(job, uid, idea, claim):
+    if job is None: return None
+    with job:
+        await job.admit()
+        return await llm.chat(script_prompt(idea, claim), key=uid, feature='script')
+
+async def take_speculation(uid, ideas, idx):
+    # فقط سناریویی که نوبتش رسیده منتظر می‌ماند؛ اگر هنوز در صف است لغو می‌شود و کاربر با نوبت و اولویت خودش تولید می‌کند
+    spec = speculations.get(uid)
+    if not spec or spec['ideas'] != ideas: return None
+    job, task = spec['jobs'][idx], spec['tasks'][idx]
+    if not task.done() and not (job and job.admitted):
+        task.cancel(); return None
+    try: return await task
+    except (Exception, asyncio.CancelledError): return None
+
 async def gen_ideas(update, context):
     query = update.callback_query; await query.answer(); context.user_data['emotion'] = query.data
-    wait = await query.message.reply_text("🔮 طراحی استراتژی...")
-    try:
-        p, c = context.user_data['profile'], context.user_data['claim']
-        prompt = f"3 Reels ideas for {p['business']} based on '{c}'. Return JSON: {{'ideas': [{{'type': '...', 'title': '...', 'hook': '...'}}]}}"
-        res = client.chat.completions.create(model="gpt-4o", response_format={"type": "json_object"}, messages=[{"role": "user", "content": prompt}])
-        ideas = json.loads(res.choices[0].message.content)['ideas']; context.user_data['ideas'] = ideas
-        kb = [[InlineKeyboardButton(f"🎬 {id['type'].upper()}", callback_data=f'expand_{i}')] for i, id in enumerate(ideas)]
-        await wait.edit_text("💎 یک زاویه‌دید انتخاب کنید:", reply_markup=InlineKeyboardMarkup(kb)); return EXPAND
-    except: await wait.edit_text("❌ خطا."); return ConversationHandler.END
+    job = await claim_job(update, 'ideas')
+    if not job: return ConversationHandler.END
+    with job:
+        wait = await query.message.reply_text("🔮 طراحی استراتژی...")
+        try:
+            await admit(job, wait)
+            p, c = context.user_data['profile'], context.user_data['claim']
+            ideas = await cached_chat('ideas', ideas_prompt(p, c), parse=parse_ideas, response_format={"type": "json_object"}, key=update.effective_user.id)
+            context.user_data['ideas'] = ideas
+            await speculate(update.effective_user.id, ideas, c)
+            kb = [[InlineKeyboardButton(f"🎬 {id['type'].upper()}", callback_data=f'expand_{i}')] for i, id in enumerate(ideas)]
+            await wait.edit_text("💎 یک زاویه‌دید انتخاب کنید:", reply_markup=InlineKeyboardMarkup(kb)); return EXPAND
+        except: await wait.edit_text("❌ خطا."); return ConversationHandler.END
 async def expand_scenario(update, context):
     query = update.callback_query; await query.answer()
-    idea = context.user_data['ideas'][int(query.data.split('_')[1])]
+    ideas, idx = context.user_data['ideas'], int(query.data.split('_')[1])
+    idea = ideas[idx]
     context.user_data['dalle_topic'] = idea['title']
     prof, claim = context.user_data['profile'], context.user_data['claim']
-    wait = await query.message.reply_text(f"📝 نگارش سناریو...")
-    try:
-        prompt = f"Write a 20s Reels script. Topic: {idea['title']}, Claim: {claim}. No 'hello', no 'like/comment'. Focus on hook. Persian language."
-        script = client.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": prompt}]).choices[0].message.content.replace('*', '')
-        context.user_data['last_script'] = script
-        kb = [[InlineKeyboardButton("🎨 تولید کاور (VIP)", callback_data='dalle_trigger')], [InlineKeyboardButton("🎙 دریافت ویس (VIP)", callback_data='tts_generate')], [InlineKeyboardButton("🔙 بازگشت", callback_data='cancel')]]
-        await wait.edit_text(script, reply_markup=InlineKeyboardMarkup(kb))
-        log_event(str(update.effective_user.id), 'ideas_generated')
-    except: await wait.edit_text("❌ خطا."); return ConversationHandler.END
+    job = await claim_job(update, 'script')
+    if not job: return
+    with job:
+        reservation = await reserve_quota(update, str(update.effective_user.id))
+        if not reservation: return ConversationHandler.END
+        wait = await query.message.reply_text(f"📝 نگارش سناریو...")
+        try:
+            kb = InlineKeyboardMarkup([[InlineKeyboardButton("🎨 تولید کاور (VIP)", callback_data='dalle_trigger')], [InlineKeyboardButton("🎙 دریافت ویس (VIP)", callback_data='tts_generate')], [InlineKeyboardButton("🔙 بازگشت", callback_data='cancel')]])
+            # سناریوی پیش‌دستانه جای خودش را در صف دارد؛ فقط اگر نبود برای تولید نوبت گرفته می‌شود
+            script = await take_speculation(update.effective_user.id, ideas, idx)
+            if script is not None:
+                script = script.replace('*', ''); await wait.edit_text(script[:MAX_MESSAGE_LEN], reply_markup=kb)
+            else:
+                await admit(job, wait)
+                script = await answer(wait, script_prompt(idea, claim), feature='script', key=update.effective_user.id, reply_markup=kb, cache=False)
+            context.user_data['last_script'] = script
+            await reservation.commit(); log_event(str(update.effective_user.id), 'ideas_generated')
+        except: await reservation.refund(); await wait.edit_text("❌ خطا."); return ConversationHandler.END
 
 # --- تولید ویس (TTS) ---
+async def synthesize(text, key=None, on_first=None):
+    # متن بر اساس جمله تکه می‌شود، تکه‌ها همزمان ساخته و به ترتیب در یک ویس Ogg Opus به هم وصل می‌شوند
+    chunks = split_text(text, TTS_CHUNK_CHARS, TTS_PREVIEW_CHARS if on_first else None)
+    sem = asyncio.Semaphore(TTS_WORKERS)
+    async def one(chunk):
+        async with sem: return await llm.speech(chunk, key=key)
+    tasks = [asyncio.ensure_future(one(c)) for c in chunks]
+    try:
+        if on_first and len(tasks) > 1: await on_first(await tasks[0])
+        return merge_ogg_opus(await asyncio.gather(*tasks))
+    finally:
+        for t in tasks: t.cancel()
+
 async def generate_tts(update, context):
-    query = update.callback_query; await query.answer(); uid = str(update.effective_user.id)
-    if not await is_user_vip(uid) and not is_admin(uid):
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="💎 مخصوص VIP است."); return
+    query = update.callback_query; uid = str(update.effective_user.id)
     script = context.user_data.get('last_script')
-    if not script: return
-    wait = await context.bot.send_message(chat_id=update.effective_chat.id, text="🎙 در حال ضبط صدا...")
-    try:
-        res = client.audio.speech.create(model="tts-1", voice="onyx", input=script[:4000])
-        path = f"tts_{uid}.ogg"; res.write_to_file(path)
-        with open(path, 'rb') as f: await context.bot.send_voice(chat_id=update.effective_chat.id, voice=f)
-        os.remove(path); await wait.delete(); log_event(uid, 'vip_tts_generated')
-    except: await wait.edit_text("❌ خطا.")
+    if not script: await query.answer(); return
+    artifact = artifact_key('tts', 'onyx', script)
+    flight = await claim_flight(query, 'tts', artifact)
+    if not flight: return
+    with flight:
+        if not await is_user_vip(uid) and not is_admin(uid):
+            await context.bot.send_message(chat_id=update.effective_chat.id, text="💎 مخصوص VIP است."); return
+        if await resend_artifact(context.bot, update.effective_chat.id, artifact, filename="voice.ogg"):
+            log_event(uid, 'vip_tts_reused'); return
+        job = await claim_job(update, 'tts')
+        if not job: return
+        with job:
+            wait = await context.bot.send_message(chat_id=update.effective_chat.id, text="🎙 در حال ضبط صدا...")
+            try:
+                await admit(job, wait)
+                async def preview(audio): await context.bot.send_voice(chat_id=update.effective_chat.id, voice=audio, filename="preview.ogg", caption="🎧 پیش‌نمایش")
+                audio = await synthesize(script, key=update.effective_user.id, on_first=preview if TTS_PREVIEW_CHARS else None)
+                file_id = await send_artifact(context.bot, update.effective_chat.id, artifact, 'tts', audio, filename="voice.ogg")
+                await wait.delete(); log_event(uid, 'vip_tts_generated')
+                await artifacts.put(artifact, 'tts', file_id, data=audio)
+            except: await wait.edit_text("❌ خطا.")
 
 async def handle_dalle_trigger(update, context):
-    query = update.callback_query; await query.answer(); uid = str(update.effective_user.id)
-    if not await is_user_vip(uid) and not is_admin(uid): return
+    query = update.callback_query; uid = str(update.effective_user.id)
     topic = context.user_data.get('dalle_topic', 'Reel')
-    wait = await context.bot.send_message(chat_id=update.effective_chat.id, text="🎨 طراحی کاور...")
-    try:
-        res = client.images.generate(model="dall-e-3", prompt=f"Instagram cover for {topic}, high quality, no text", size="1024x1792", n=1)
-        await context.bot.send_photo(chat_id=update.effective_chat.id, photo=res.data[0].url); await wait.delete()
-        log_event(uid, 'dalle_generated')
-    except: await wait.edit_text("❌ خطا.")
+    prompt = f"Instagram cover for {topic}, high quality, no text"
+    artifact = artifact_key('cover', prompt)
+    flight = await claim_flight(query, 'cover', artifact)
+    if not flight: return
+    with flight:
+        if not await is_user_vip(uid) and not is_admin(uid): return
+        if await resend_artifact(context.bot, update.effective_chat.id, artifact):
+            log_event(uid, 'dalle_reused'); return
+        job = await claim_job(update, 'cover')
+        if not job: return
+        with job:
+            wait = await context.bot.send_message(chat_id=update.effective_chat.id, text="🎨 طراحی کاور...")
+            try:
+                await admit(job, wait)
+                url = await llm.image(prompt, size="1024x1792", key=update.effective_user.id)
+                file_id = await send_artifact(context.bot, update.effective_chat.id, artifact, 'cover', url); await wait.delete()
+                log_event(uid, 'dalle_generated')
+                await artifacts.put(artifact, 'cover', file_id, url=url)
+            except: await wait.edit_text("❌ خطا.")
+
+async def send_again(update, context):
+    query = update.callback_query; await query.answer()
+    if not await resend_artifact(context.bot, update.effective_chat.id, query.data.split('_', 1)[1]):
+        await query.message.reply_text("⌛ این فایل دیگر در دسترس نیست؛ لطفاً دوباره بسازید.")
 
 # --- هشتگ و آنالیز رقیب ---
 async def hashtag_start(update, context):
     await update.message.reply_text("🏷 موضوع پست؟"); return H_TOPIC
 async def hashtag_generate(update, context):
     uid = str(update.effective_user.id); topic = update.message.text
-    if not await check_daily_limit(update, uid): return ConversationHandler.END
-    wait = await update.message.reply_text("⏳ استخراج..."); res = client.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": f"20 Hashtags for {topic}"}])
-    await wait.edit_text(res.choices[0].message.content.replace('*', '')); log_event(uid, 'hashtags_success'); return ConversationHandler.END
+    job = await claim_job(update, 'hashtags')
+    if not job: return ConversationHandler.END
+    with job:
+        reservation = await reserve_quota(update, uid)
+        if not reservation: return ConversationHandler.END
+        wait = await update.message.reply_text("⏳ استخراج...")
+        try:
+            await admit(job, wait)
+            await answer(wait, f"20 Hashtags for {topic}", feature='hashtags', key=update.effective_user.id)
+            await reservation.commit(); log_event(uid, 'hashtags_generated_success')
+        except: await reservation.refund(); await wait.edit_text("❌ خطا.")
+    return ConversationHandler.END
 
 async def analyze_start(update, context):
     await update.message.reply_text("🕵️‍♂️ متن ریلز موفق را بفرستید:"); return SPY_TEXT
 async def analyze_competitor(update, context):
     uid = str(update.effective_user.id); text = update.message.text
-    wait = await update.message.reply_text("🕵️‍♂️ تحلیل..."); res = client.chat.completions.create(model="gpt-4o", messages=[{"role": "user", "content": f"Analyze this viral reel script: {text}"}])
-    await wait.edit_text(res.choices[0].message.content.replace('*', '')); log_event(uid, 'spy_success'); return ConversationHandler.END
+    job = await claim_job(update, 'spy')
+    if not job: return ConversationHandler.END
+    with job:
+        wait = await update.message.reply_text("🕵️‍♂️ تحلیل...")
+        try:
+            await admit(job, wait)
+            await answer(wait, f"Analyze this viral reel script: {text}", feature='spy', key=update.effective_user.id); log_event(uid, 'spy_success')
+        except: await wait.edit_text("❌ خطا.")
+    return ConversationHandler.END
+
+# --- تقویم محتوا (تولید دسته‌ای سناریو) ---
+async def bulk_start(update, context):
+    uid = str(update.effective_user.id)
+    if not await is_user_vip(uid) and not is_admin(uid):
+        await update.message.reply_text("💎 تقویم محتوا مخصوص VIP است."); return ConversationHandler.END
+    if not await get_profile(uid):
+        await update.message.reply_text("❌ ابتدا پروفایل بسازید."); return ConversationHandler.END
+    paused = await bulk_store.jobs('paused', uid)
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("▶️ ادامه تقویم نیمه‌تمام", callback_data=f"bulk_resume_{paused[-1]['id']}")]]) if paused else None
+    await update.message.reply_text(f"🗓 ادعاها یا موضوع‌ها را هر کدام در یک خط بفرستید، یا فقط تعداد روزها را (حداکثر {BULK_MAX_ITEMS}):", reply_markup=kb)
+    return BULK_INPUT
+
+async def bulk_submit(update, context):
+    uid = str(update.effective_user.id); text = update.message.text.strip()
+    prof = await get_profile(uid)
+    if text.isdigit():
+        count = max(1, min(int(text), BULK_MAX_ITEMS))
+        job = await claim_job(update, 'claims')
+        if not job: return ConversationHandler.END
+        with job:
+            wait = await update.message.reply_text("🧭 انتخاب موضوع‌ها...")
+            try:
+                await admit(job, wait)
+                prompt = f"{count} different provocative claims for Reels of a {prof['business']} page. Audience: {prof['audience']}. Persian language. Return JSON: {{'claims': ['...']}}"
+                claims = json.loads(await llm.chat(prompt, response_format={"type": "json_object"}, key=update.effective_user.id, feature='claims'))['claims'][:count]
+                await wait.delete()
+            except: await wait.edit_text("❌ خطا."); return ConversationHandler.END
+    else: claims = [line.strip() for line in text.splitlines() if line.strip()][:BULK_MAX_ITEMS]
+    job_id = await bulk_store.create(uid, update.effective_chat.id, prof, claims)
+    log_event(uid, 'bulk_started', str(len(claims)))
+    start_bulk(context.bot, job_id)
+    return ConversationHandler.END
+
+def start_bulk(bot, job_id):
+    if job_id in bulk_tasks: return
+    bulk_tasks[job_id] = asyncio.create_task(run_bulk(bot, job_id))
+    bulk_tasks[job_id].add_done_callback(lambda t: bulk_tasks.pop(job_id, None))
+
+def bulk_kb(job_id, action):
+    label = "⏹ توقف" if action == 'stop' else "▶️ ادامه"
+    return InlineKeyboardMarkup([[InlineKeyboardButton(label, callback_data=f"bulk_{action}_{job_id}")]])
+
+async def save_item(job_id, item):
+    await bulk_store.update_item(job_id, item['idx'], **{k: item[k] for k in ('idea', 'script', 'state') if item[k] is not None})
+
+def take_idea(item, ideas):
+    item.update(idea=ideas[item['idx'] % len(ideas)], state='idea')
+
+async def bulk_step(job, item):
+    # یک مرحله از یک مورد؛ بعد از هر مرحله ذخیره می‌شود تا کار ازسرگرفته‌شده همان مرحله را تکرار نکند
+    key = ('bulk', job['id'])
+    if item['state'] == 'pending':
+        take_idea(item, await cached_chat('ideas', ideas_prompt(job['profile'], item['claim']), parse=parse_ideas, response_format={"type": "json_object"}, key=key))
+    else: item.update(script=(await llm.chat(script_prompt(item['idea'], item['claim']), key=key, feature='script')).replace('*', ''), state='script')
+    await save_item(job['id'], item)
+
+async def bulk_batch_stage(job, items, state):
+    # همه موردهای یک مرحله در یک کار Batch API؛ شناسه آن ذخیره می‌شود تا بعد از ری‌استارت همان کار دنبال شود
+    todo = [i for i in items if i['state'] == state]
+    if not todo: return
+    if job['batch_id'] and job['batch_stage'] == state: batch_id = job['batch_id']
+    else:
+        if state == 'pending': requests = [(str(i['idx']), ideas_prompt(job['profile'], i['claim']), {'response_format': {"type": "json_object"}}) for i in todo]
+        else: requests = [(str(i['idx']), script_prompt(i['idea'], i['claim']), {}) for i in todo]
+        batch_id = await llm.submit_batch(requests, feature='ideas' if state == 'pending' else 'script')
+        await bulk_store.update_job(job['id'], batch_id=batch_id, batch_stage=state)
+    results = await llm.batch_results(batch_id)
+    for item in todo:
+        reply = results.get(str(item['idx']))
+        if reply is None: continue
+        try:
+            if state == 'pending': take_idea(item, parse_ideas(reply))
+            else: item.update(script=reply.replace('*', ''), state='script')
+        except (ValueError, KeyError, TypeError): continue
+        await save_item(job['id'], item)
+    job.update(batch_id=None, batch_stage=None)
+    await bulk_store.update_job(job['id'], batch_id=None, batch_stage=None)
+
+async def run_bulk(bot, job_id):
+    # هر مورد مستقل از بقیه ایده ← سناریو می‌شود و به محض آماده شدن در چت فرستاده می‌شود
+    job, items = await bulk_store.job(job_id), await bulk_store.items(job_id)
+    chat_id, total = job['chat_id'], len(items)
+    progress = lambda: f"🗓 تقویم محتوا: {sum(i['state'] == 'sent' for i in items)}/{total} آماده"
+    # claim کل تقویم فقط از اجرای همزمان دو تقویم برای یک کاربر جلوگیری می‌کند؛ نوبت صف برای هر مرحله هر مورد جدا گرفته می‌شود
+    bulk_job = scheduler.claim(job['user_id'], 'calendar')
+    if bulk_job is None:
+        await bulk_store.update_job(job_id, status='paused')
+        await bot.send_message(chat_id=chat_id, text="⏳ تقویم قبلی شما هنوز در حال ساخت است؛ بعد از پایان آن ادامه دهید.", reply_markup=bulk_kb(job_id, 'resume')); return
+    await bulk_store.update_job(job_id, status='running')
+    wait = await bot.send_message(chat_id=chat_id, text=progress(), reply_markup=bulk_kb(job_id, 'stop'))
+    async def deliver(item):
+        await bot.send_message(chat_id=chat_id, text=f"📅 روز {item['idx'] + 1} — {item['idea']['title']}\n\n{item['script']}"[:MAX_MESSAGE_LEN])
+        item['state'] = 'sent'; await save_item(job_id, item)
+        try: await wait.edit_text(progress(), reply_markup=bulk_kb(job_id, 'stop'))
+        except (BadRequest, RetryAfter): pass
+    sem = asyncio.Semaphore(BULK_CONCURRENCY)
+    async def advance(item):
+        async with sem:
+            try:
+                while item['state'] in ('pending', 'idea'):
+                    # هر مرحله یک جای صف پذیرش (در صف عادی) می‌گیرد تا تقویم‌ها از ADMISSION_CAPACITY بیشتر مصرف نکنند
+                    with scheduler.claim(job['user_id'], f"calendar_{job_id}_{item['idx']}") as step:
+                        await step.admit()
+                        await bulk_step(job, item)
+                await deliver(item)
+            except Exception as e: logger.warning(f"Bulk job {job_id} item {item['idx']} failed: {e}")
+    with bulk_job:
+        try:
+            # کار Batch API ظرفیت صف پذیرش را نمی‌گیرد؛ فقط موردهای باقی‌مانده از صف می‌گذرند
+            if BULK_BATCH or job['batch_id']:
+                for state in ('pending', 'idea'): await bulk_batch_stage(job, items, state)
+            await asyncio.gather(*(advance(i) for i in items if i['state'] != 'sent'))
+        except asyncio.CancelledError: raise
+        except Exception as e: logger.error(f"Bulk job {job_id} failed: {e}")
+    left = sum(i['state'] != 'sent' for i in items)
+    await bulk_store.update_job(job_id, status='paused' if left else 'done')
+    if left: await wait.edit_text(f"{progress()}\n⚠️ {left} مورد ناتمام ماند.", reply_markup=bulk_kb(job_id, 'resume'))
+    else: await wait.edit_text(f"{progress()} ✅"); log_event(job['user_id'], 'bulk_completed', str(total))
+
+async def bulk_control(update, context):
+    query = update.callback_query; await query.answer()
+    _, action, job_id = query.data.split('_'); job_id = int(job_id)
+    job = await bulk_store.job(job_id)
+    if not job or job['user_id'] != str(update.effective_user.id): return ConversationHandler.END
+    if action == 'stop':
+        # فقط توقف کاربر کار را paused می‌کند؛ کارهایی که با خاموش شدن ربات قطع شوند running می‌مانند
+        await bulk_store.update_job(job_id, status='paused')
+        if task := bulk_tasks.get(job_id): task.cancel()
+        await query.edit_message_text("⏸ تقویم محتوا متوقف شد.", reply_markup=bulk_kb(job_id, 'resume'))
+    elif job['status'] != 'done':
+        await query.edit_message_reply_markup(None); start_bulk(context.bot, job_id)
+    return ConversationHandler.END
+
+async def resume_bulk_jobs(bot):
+    # هر ورکر فقط کارهای کاربرانی را ادامه می‌دهد که پروسه جلویی به آن می‌فرستد
+    for job in await bulk_store.jobs('running'):
+        if int(job['user_id']) % WORKER_COUNT == WORKER_INDEX: start_bulk(bot, job['id'])
 
 # --- سیستم VIP و مالی ---
 async def show_referral(update, context):
@@ -450,37 +994,89 @@ async def admin_pay_handle(update, context):
     if not is_admin(update.effective_user.id): return
     action, _, target = query.data.split('_')
     if action == 'v':
-        supabase.table('profiles').update({'is_vip': True}).eq('user_id', target).execute()
+        await repo.set_vip(target); await invalidate_user(target)
         await context.bot.send_message(chat_id=target, text="🎉 حساب شما VIP شد!")
     await query.edit_message_caption(caption="اعمال شد.")
+async def admin_stats(update, context):
+    if not is_admin(update.effective_user.id): return
+    e = entitlements.stats()
+    msg = f"📊 کش دسترسی‌ها: {e['size']} کاربر | hit {e['hits']} | miss {e['misses']} | {e['hit_ratio']:.0%}"
+    if event_log:
+        l = event_log.stats()
+        msg += f"\n📝 لاگ‌ها: صف {l['queued']} | ثبت {l['written']} | حذف {l['dropped']} | خطا {l['failed']} | اسپول {l['spooled']}"
+    p = profiles.stats()
+    msg += f"\n👤 کش پروفایل: {p['size']} | hit {p['hits']} | miss {p['misses']} | {p['hit_ratio']:.0%}"
+    r = response_cache.stats()
+    msg += f"\n🗂 کش پاسخ‌ها: hit {r['hits']} | miss {r['misses']} | {r['hit_ratio']:.0%}"
+    await update.message.reply_text(msg)
 
 # --- منو و استارت ---
 def main_kb():
     return ReplyKeyboardMarkup([
         [KeyboardButton("🎬 سناریوساز استراتژیک"), KeyboardButton("🧠 مربی ایده و آنالیزور")],
-        [KeyboardButton("🎨 طراحی لوگو (VIP)")],
+        [KeyboardButton("🎨 طراحی لوگو (VIP)"), KeyboardButton("🗓 تقویم محتوا (VIP)")],
         [KeyboardButton("🏷 هشتگ‌ساز"), KeyboardButton("🕵️‍♂️ تحلیل رقبا")],
         [KeyboardButton("👤 پروفایل"), KeyboardButton("🎁 هدیه")],
         [KeyboardButton("💎 ارتقا VIP")]
     ], resize_keyboard=True)
 
 async def start(update, context):
+    llm.cancel(update.effective_user.id); drop_speculation(update.effective_user.id)
     if context.args and context.args[0].startswith('ref_'):
         ref = context.args[0].split('_')[1]; uid = str(update.effective_user.id)
         if ref != uid: 
-            try: supabase.table('profiles').upsert({'user_id': uid, 'referred_by': ref}, on_conflict='user_id').execute()
+            try: await save_profile({'user_id': uid, 'referred_by': ref}); await invalidate_user(ref)
             except: pass
     await update.message.reply_text("🚀 خوش آمدید!", reply_markup=main_kb())
 
 # --- اجرای نهایی ---
-if __name__ == '__main__':
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+lag_monitor = None
+
+async def on_startup(app):
+    global lag_monitor
+    if event_log: event_log.start()
+    lag_monitor = asyncio.create_task(metrics.monitor_loop_lag())
+    await http_server.start(HOST, PORT)
+    await resume_bulk_jobs(app.bot)
+
+async def on_shutdown(app):
+    if lag_monitor: lag_monitor.cancel()
+    # کارهای تقویم «running» می‌مانند تا در اجرای بعدی از همان مورد ادامه پیدا کنند
+    for task in list(bulk_tasks.values()): task.cancel()
+    await http_server.close()
+    if event_log: await event_log.stop()
+    if repo: await repo.close()
+    response_cache.close()
+    artifacts.close()
+    bulk_store.close()
+
+async def run_webhook(app):
+    add_webhook_route(app)
+    await app.initialize(); await on_startup(app)
+    if WEBHOOK_URL:
+        await app.bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES)
+    await app.start()
+    stop = asyncio.Event(); loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM): loop.add_signal_handler(sig, stop.set)
+    try: await stop.wait()
+    finally:
+        await app.stop(); await app.shutdown(); await on_shutdown(app)
+
+def build_app():
+    # پردازش همزمان آپدیت‌ها تا فراخوانی‌های طولانی OpenAI بقیه کاربران را معطل نکند
+    builder = ApplicationBuilder().token(TELEGRAM_TOKEN).concurrent_updates(int(os.environ.get("CONCURRENT_UPDATES", 256))).post_init(on_startup).post_shutdown(on_shutdown)
+    if TELEGRAM_BASE_URL: builder = builder.base_url(f"{TELEGRAM_BASE_URL}/bot").base_file_url(f"{TELEGRAM_BASE_URL}/file/bot")
+    if PERSISTENCE_PATH: builder = builder.persistence(SQLitePersistence(PERSISTENCE_PATH))
+    app = builder.build()
+    persistent = bool(PERSISTENCE_PATH)
     app.add_handler(CommandHandler('start', start))
+    app.add_handler(CommandHandler('stats', admin_stats))
     app.add_handler(MessageHandler(filters.Regex('^💎 ارتقا VIP$'), upgrade_vip))
     app.add_handler(MessageHandler(filters.Regex('^🎁 هدیه$'), show_referral))
     app.add_handler(CallbackQueryHandler(admin_pay_handle, pattern='^[vr]_p_'))
     app.add_handler(CallbackQueryHandler(handle_dalle_trigger, pattern='^dalle_trigger$'))
     app.add_handler(CallbackQueryHandler(generate_tts, pattern='^tts_generate$'))
+    app.add_handler(CallbackQueryHandler(send_again, pattern='^again_'))
     app.add_handler(CallbackQueryHandler(start, pattern='^cancel$'))
 
     # طراحی لوگو Conversation
@@ -491,36 +1087,59 @@ if __name__ == '__main__':
             LOGO_CUSTOM_PROMPT: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_custom_logo_topic)],
             LOGO_STYLE_SELECT: [CallbackQueryHandler(generate_logo_final, pattern='^ls_')]
         },
-        fallbacks=[CommandHandler('cancel', start)]
+        fallbacks=[CommandHandler('cancel', start)],
+        name='logo', persistent=persistent
     ))
 
     # پروفایل Conversation
     app.add_handler(ConversationHandler(
         entry_points=[MessageHandler(filters.Regex('^👤 پروفایل$'), profile_start), CallbackQueryHandler(profile_start, pattern='^re_edit_profile$')],
         states={P_BUSINESS: [MessageHandler(filters.TEXT, get_business)], P_GOAL: [CallbackQueryHandler(get_goal)], P_AUDIENCE: [MessageHandler(filters.TEXT, get_audience)], P_TONE: [CallbackQueryHandler(get_tone_and_save)]},
-        fallbacks=[CommandHandler('cancel', start)]
+        fallbacks=[CommandHandler('cancel', start)], name='profile', persistent=persistent
     ))
 
     # سناریو Conversation
     app.add_handler(ConversationHandler(
         entry_points=[MessageHandler(filters.Regex('^🎬 سناریوساز استراتژیک$'), scenario_init)],
         states={C_CLAIM: [MessageHandler(filters.TEXT | filters.VOICE, get_claim)], C_EMOTION: [CallbackQueryHandler(gen_ideas)], EXPAND: [CallbackQueryHandler(expand_scenario, pattern='^expand_')]},
-        fallbacks=[CommandHandler('cancel', start)]
+        fallbacks=[CommandHandler('cancel', start)], name='scenario', persistent=persistent
     ))
 
     # مربی Conversation
     app.add_handler(ConversationHandler(
         entry_points=[MessageHandler(filters.Regex('^🧠 مربی ایده و آنالیزور$'), coach_start)],
         states={C_TEXT: [MessageHandler(filters.PHOTO | filters.TEXT | filters.VOICE, coach_analyze)]},
-        fallbacks=[CommandHandler('cancel', start)]
+        fallbacks=[CommandHandler('cancel', start)], name='coach', persistent=persistent
     ))
 
     # هشتگ و آنالیز
     app.add_handler(ConversationHandler(
         entry_points=[MessageHandler(filters.Regex('^🏷 هشتگ‌ساز$'), hashtag_start), MessageHandler(filters.Regex('^🕵️‍♂️ تحلیل رقبا$'), analyze_start)],
         states={H_TOPIC: [MessageHandler(filters.TEXT, hashtag_generate)], SPY_TEXT: [MessageHandler(filters.TEXT, analyze_competitor)]},
-        fallbacks=[CommandHandler('cancel', start)]
+        fallbacks=[CommandHandler('cancel', start)], name='tools', persistent=persistent
+    ))
+
+    # تقویم محتوا Conversation؛ دکمه‌های توقف و ادامه بیرون از گفتگو هم کار می‌کنند
+    app.add_handler(ConversationHandler(
+        entry_points=[MessageHandler(filters.Regex('^🗓 تقویم محتوا \(VIP\)$'), bulk_start)],
+        states={BULK_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, bulk_submit), CallbackQueryHandler(bulk_control, pattern='^bulk_resume_')]},
+        fallbacks=[CommandHandler('cancel', start)], name='bulk', persistent=persistent
     ))
+    app.add_handler(CallbackQueryHandler(bulk_control, pattern='^bulk_(stop|resume)_'))
 
     app.add_handler(MessageHandler(filters.PHOTO, handle_receipt))
-    app.run_polling()
+    instrument(app)
+    return app
+
+if __name__ == '__main__':
+    if WORKERS > 1:
+        if BOT_MODE != 'webhook' or not WEBHOOK_URL:
+            # بدون وب‌هوک ثبت‌شده هیچ آپدیتی به پروسه جلویی نمی‌رسد و ربات بی‌صدا کار نمی‌کند
+            logger.error("WORKERS > 1 needs BOT_MODE=webhook and WEBHOOK_URL; refusing to start")
+            raise SystemExit(1)
+        if not PERSISTENCE_PATH: logger.warning("WORKERS > 1 without PERSISTENCE_PATH: conversations are lost when a worker restarts")
+        asyncio.run(Front(os.path.abspath(__file__), WORKERS, PORT, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_URL, TELEGRAM_TOKEN).run())
+        raise SystemExit
+    app = build_app()
+    if BOT_MODE == 'webhook': asyncio.run(run_webhook(app))
+    else: app.run_polling()
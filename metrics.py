@@ -0,0 +1,174 @@
+import os, time, asyncio, functools
+from bisect import bisect_left
+
+# --- متریک‌ها با قالب متنی Prometheus (بدون وابستگی خارجی) ---
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", 0.5))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + list(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _num(value):
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, doc, labels=()):
+        self.name, self.doc, self.labelnames = name, doc, tuple(labels)
+        self._values = {}
+        registry.metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, '')) for n in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self._values.items()): lines.extend(self._lines(key, value))
+        return '\n'.join(lines) + '\n'
+
+    def _lines(self, key, value):
+        return [f"{self.name}{_labels(self.labelnames, key)} {_num(value)}"]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        # برای شمارنده‌هایی که جای دیگری نگه داشته می‌شوند و هنگام خواندن کپی می‌شوند
+        self._values[self._key(labels)] = value
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        item = self._values.get(key)
+        if item is None: item = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        item[0][bisect_left(self.buckets, value)] += 1
+        item[1] += value
+
+    def _lines(self, key, value):
+        counts, total = value
+        lines, running = [], 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            running += n
+            le = 'le="%s"' % _num(bound)
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [le])} {running}")
+        lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_num(total)}")
+        lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {running}")
+        return lines
+
+
+class Registry:
+    """Holds metrics and renders them in the Prometheus text format.
+
+    Functions registered with :meth:`collector` run right before each render
+    to refresh gauges that are cheaper to read on demand (queue sizes, caches).
+    """
+
+    def __init__(self):
+        self.metrics, self.collectors = [], []
+
+    def collector(self, fn):
+        self.collectors.append(fn)
+        return fn
+
+    def render(self):
+        for fn in self.collectors: fn()
+        return ''.join(m.render() for m in self.metrics)
+
+
+registry = Registry()
+
+handler_seconds = Histogram(registry, 'bot_handler_seconds', 'Telegram handler latency.', ('handler', 'outcome'))
+openai_seconds = Histogram(registry, 'bot_openai_request_seconds', 'OpenAI request latency, including time queued for the model limit.', ('model', 'outcome'))
+openai_queue_seconds = Histogram(registry, 'bot_openai_queue_seconds', 'Time an OpenAI request waited for its model concurrency slot.', ('model',))
+openai_inflight = Gauge(registry, 'bot_openai_inflight', 'OpenAI requests currently running.', ('model',))
+openai_retries = Counter(registry, 'bot_openai_retries_total', 'OpenAI requests retried after 429, 5xx or connection errors.', ('model', 'reason'))
+openai_tokens = Counter(registry, 'bot_openai_tokens_total', 'Tokens reported by OpenAI.', ('model', 'kind'))
+openai_fallbacks = Counter(registry, 'bot_openai_fallbacks_total', 'Chat requests moved to the fallback model after the primary stayed overloaded.', ('model', 'fallback'))
+openai_trimmed = Counter(registry, 'bot_openai_trimmed_total', 'Prompts shortened to fit the input token budget of their feature.', ('feature',))
+vision_bytes = Counter(registry, 'bot_vision_image_bytes_total', 'Cover image bytes: largest Telegram size (original) vs. what was sent.', ('kind',))
+vision_tokens = Counter(registry, 'bot_vision_image_tokens_total', 'Estimated image input tokens: largest size at high detail (original) vs. sent.', ('kind',))
+db_seconds = Histogram(registry, 'bot_db_request_seconds', 'Supabase (PostgREST) request latency.', ('method', 'table', 'outcome'))
+admission_wait_seconds = Histogram(registry, 'bot_admission_wait_seconds', 'Time a generation job waited for an admission slot.', ('lane',))
+admission_rejected = Counter(registry, 'bot_admission_rejected_total', 'Jobs refused because the user already had one running for the feature.', ('feature',))
+duplicate_requests = Counter(registry, 'bot_duplicate_requests_total', 'Repeated taps answered while the same action with the same input was still running.', ('action',))
+loop_lag_seconds = Histogram(registry, 'bot_event_loop_lag_seconds', 'Extra delay of a periodic event-loop timer.', buckets=LAG_BUCKETS)
+queue_depth = Gauge(registry, 'bot_queue_depth', 'Items waiting in internal queues.', ('queue',))
+cache_entries = Gauge(registry, 'bot_cache_entries', 'Entries held in in-memory caches.', ('cache',))
+cache_requests = Counter(registry, 'bot_cache_requests_total', 'Cache lookups since start by result.', ('cache', 'result'))
+eventlog_rows = Counter(registry, 'bot_eventlog_rows_total', 'Event log rows since start by result.', ('result',))
+
+
+def outcome(exc):
+    if exc is None: return 'ok'
+    if isinstance(exc, asyncio.CancelledError): return 'cancelled'
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError)): return 'timeout'
+    return 'error'
+
+
+def timed_handler(callback):
+    """Wrap a PTB handler callback so every call lands in ``bot_handler_seconds``."""
+    if getattr(callback, 'timed', False): return callback
+    name = callback.__name__
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started, exc = time.perf_counter(), None
+        try: return await callback(update, context)
+        except BaseException as e: exc = e; raise
+        finally: handler_seconds.observe(time.perf_counter() - started, handler=name, outcome=outcome(exc))
+    wrapper.timed = True
+    return wrapper
+
+
+def record_usage(model, usage):
+    if usage is None: return
+    openai_tokens.inc(getattr(usage, 'prompt_tokens', 0) or getattr(usage, 'input_tokens', 0) or 0, model=model, kind='prompt')
+    openai_tokens.inc(getattr(usage, 'completion_tokens', 0) or getattr(usage, 'output_tokens', 0) or 0, model=model, kind='completion')
+
+
+async def monitor_loop_lag(interval=LOOP_LAG_INTERVAL):
+    # تأخیر بیدار شدن یک تایمر دوره‌ای؛ مقدار بالا یعنی کاری همگام حلقه رویداد را بسته است
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        loop_lag_seconds.observe(max(0.0, loop.time() - started - interval))
+
+
+async def handle_metrics(request):
+    return 200, registry.render(), 'text/plain; version=0.0.4; charset=utf-8'
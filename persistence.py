@@ -0,0 +1,98 @@
+import os, json, pickle
+from telegram.ext import BasePersistence, PersistenceInput
+from sqlitestore import SQLiteStore
+
+# --- ذخیره وضعیت گفتگوها و user_data در SQLite (مشترک بین ورکرها) ---
+PERSISTENCE_UPDATE_INTERVAL = float(os.environ.get("PERSISTENCE_UPDATE_INTERVAL", 5))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB);
+CREATE TABLE IF NOT EXISTS chat_data (chat_id INTEGER PRIMARY KEY, data BLOB);
+CREATE TABLE IF NOT EXISTS bot_data (id INTEGER PRIMARY KEY CHECK (id = 0), data BLOB);
+CREATE TABLE IF NOT EXISTS callback_data (id INTEGER PRIMARY KEY CHECK (id = 0), data BLOB);
+CREATE TABLE IF NOT EXISTS conversations (name TEXT, key TEXT, state BLOB, PRIMARY KEY (name, key));
+"""
+
+
+class SQLitePersistence(SQLiteStore, BasePersistence):
+    """Persists conversation states, user_data, chat_data and bot_data in one SQLite file.
+
+    Several worker processes may share the file: rows are written per user or
+    chat, and the front process sends every update of a user to the same
+    worker, so its in-memory copy is always the latest one. Rows are only
+    reread at startup; reloading before each update would drop whatever was
+    changed since the last write (every ``update_interval`` seconds).
+    """
+
+    def __init__(self, path, store_data=None, update_interval=PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(store_data=store_data or PersistenceInput(), update_interval=update_interval)
+        self._open(path, SCHEMA, timeout=30)
+
+    def _rows(self, sql, args=()):
+        return self._db.execute(sql, args).fetchall()
+
+    def _exec(self, sql, args=()):
+        self._db.execute(sql, args)
+
+    # user_data / chat_data
+    async def _load_all(self, table, key):
+        rows = await self._run(self._rows, f"SELECT {key}, data FROM {table}")
+        return {k: pickle.loads(d) for k, d in rows}
+
+    async def _load_one(self, table, key, value):
+        rows = await self._run(self._rows, f"SELECT data FROM {table} WHERE {key} = ?", (value,))
+        return pickle.loads(rows[0][0]) if rows else None
+
+    async def get_user_data(self):
+        return await self._load_all('user_data', 'user_id')
+
+    async def update_user_data(self, user_id, data):
+        await self._run(self._exec, "INSERT OR REPLACE INTO user_data VALUES (?, ?)", (user_id, pickle.dumps(data)))
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        await self._run(self._exec, "DELETE FROM user_data WHERE user_id = ?", (user_id,))
+
+    async def get_chat_data(self):
+        return await self._load_all('chat_data', 'chat_id')
+
+    async def update_chat_data(self, chat_id, data):
+        await self._run(self._exec, "INSERT OR REPLACE INTO chat_data VALUES (?, ?)", (chat_id, pickle.dumps(data)))
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        await self._run(self._exec, "DELETE FROM chat_data WHERE chat_id = ?", (chat_id,))
+
+    # bot_data / callback_data
+    async def get_bot_data(self):
+        return await self._load_one('bot_data', 'id', 0) or {}
+
+    async def update_bot_data(self, data):
+        await self._run(self._exec, "INSERT OR REPLACE INTO bot_data VALUES (0, ?)", (pickle.dumps(data),))
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_callback_data(self):
+        return await self._load_one('callback_data', 'id', 0)
+
+    async def update_callback_data(self, data):
+        await self._run(self._exec, "INSERT OR REPLACE INTO callback_data VALUES (0, ?)", (pickle.dumps(data),))
+
+    # conversations
+    async def get_conversations(self, name):
+        rows = await self._run(self._rows, "SELECT key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(k)): pickle.loads(s) for k, s in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            await self._run(self._exec, "DELETE FROM conversations WHERE name = ? AND key = ?", (name, json.dumps(key)))
+        else:
+            await self._run(self._exec, "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)", (name, json.dumps(key), pickle.dumps(new_state)))
+
+    async def flush(self):
+        await self._run(self.close)
@@ -0,0 +1,130 @@
+import os
+from datetime import datetime, timezone
+from sqlitestore import SQLiteStore
+
+# --- دفتر سهمیه روزانه: رزرو قبل از تولید، ثبت نهایی یا بازگرداندن بعد از آن ---
+QUOTA_BACKEND = os.environ.get("QUOTA_BACKEND") # supabase | sqlite | memory
+QUOTA_DB_PATH = os.environ.get("QUOTA_DB_PATH", "quota.sqlite3")
+
+
+def today():
+    return datetime.now(timezone.utc).date().isoformat()
+
+
+class Reservation:
+    """One reserved unit of a user's daily quota; ``commit`` or ``refund`` it exactly once."""
+
+    def __init__(self, ledger, user_id, day):
+        self.ledger, self.user_id, self.day = ledger, user_id, day
+        self.done = False
+
+    async def commit(self):
+        if self.done: return
+        self.done = True
+        await self.ledger._commit(self.user_id, self.day)
+
+    async def refund(self):
+        if self.done: return
+        self.done = True
+        await self.ledger._refund(self.user_id, self.day)
+
+
+class Unlimited(Reservation):
+    """Reservation handed to admins and VIP users; it never touches the ledger."""
+
+    def __init__(self): super().__init__(None, None, None)
+    async def commit(self): pass
+    async def refund(self): pass
+
+
+class QuotaLedger:
+    """Per-user, per-UTC-day usage counter with ``used`` and ``reserved`` units.
+
+    ``reserve`` succeeds only while ``used + reserved < allowance`` and the check
+    and increment are a single atomic step in every backend.
+    """
+
+    async def reserve(self, user_id, allowance):
+        day = today()
+        ok, total = await self._reserve(str(user_id), day, allowance)
+        return (Reservation(self, str(user_id), day) if ok else None), total
+
+    async def usage(self, user_id):
+        return await self._usage(str(user_id), today())
+
+
+class MemoryQuota(QuotaLedger):
+    def __init__(self):
+        self.counters = {}
+
+    async def _reserve(self, user_id, day, allowance):
+        used, reserved = self.counters.get((user_id, day), (0, 0))
+        if used + reserved >= allowance: return False, used + reserved
+        self.counters[(user_id, day)] = (used, reserved + 1)
+        return True, used + reserved + 1
+
+    async def _commit(self, user_id, day):
+        used, reserved = self.counters.get((user_id, day), (0, 1))
+        self.counters[(user_id, day)] = (used + 1, max(0, reserved - 1))
+
+    async def _refund(self, user_id, day):
+        used, reserved = self.counters.get((user_id, day), (0, 1))
+        self.counters[(user_id, day)] = (used, max(0, reserved - 1))
+
+    async def _usage(self, user_id, day):
+        return sum(self.counters.get((user_id, day), (0, 0)))
+
+
+class SQLiteQuota(SQLiteStore, QuotaLedger):
+    """Local ledger; safe to share between worker processes on one machine."""
+
+    def __init__(self, path=QUOTA_DB_PATH):
+        self._open(path, "CREATE TABLE IF NOT EXISTS usage_counters (user_id TEXT, day TEXT, used INTEGER DEFAULT 0, reserved INTEGER DEFAULT 0, PRIMARY KEY (user_id, day))", timeout=30)
+
+    def _reserve_sync(self, user_id, day, allowance):
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.execute("INSERT OR IGNORE INTO usage_counters (user_id, day) VALUES (?, ?)", (user_id, day))
+            ok = self._db.execute("UPDATE usage_counters SET reserved = reserved + 1 WHERE user_id = ? AND day = ? AND used + reserved < ?", (user_id, day, allowance)).rowcount == 1
+            total = self._db.execute("SELECT used + reserved FROM usage_counters WHERE user_id = ? AND day = ?", (user_id, day)).fetchone()[0]
+        return ok, total
+
+    async def _reserve(self, user_id, day, allowance):
+        return await self._run(self._reserve_sync, user_id, day, allowance)
+
+    async def _commit(self, user_id, day):
+        await self._run(self._db.execute, "UPDATE usage_counters SET used = used + 1, reserved = MAX(0, reserved - 1) WHERE user_id = ? AND day = ?", (user_id, day))
+
+    async def _refund(self, user_id, day):
+        await self._run(self._db.execute, "UPDATE usage_counters SET reserved = MAX(0, reserved - 1) WHERE user_id = ? AND day = ?", (user_id, day))
+
+    async def _usage(self, user_id, day):
+        row = (await self._run(lambda: self._db.execute("SELECT used + reserved FROM usage_counters WHERE user_id = ? AND day = ?", (user_id, day)).fetchone()))
+        return row[0] if row else 0
+
+
+class SupabaseQuota(QuotaLedger):
+    """Ledger in the ``usage_counters`` table through the RPC functions in sql/usage_counters.sql."""
+
+    def __init__(self, repo):
+        self.repo = repo
+
+    async def _reserve(self, user_id, day, allowance):
+        res = await self.repo.rpc('reserve_quota', {'p_user_id': user_id, 'p_day': day, 'p_allowance': allowance})
+        return res['ok'], res['total']
+
+    async def _commit(self, user_id, day):
+        await self.repo.rpc('commit_quota', {'p_user_id': user_id, 'p_day': day})
+
+    async def _refund(self, user_id, day):
+        await self.repo.rpc('refund_quota', {'p_user_id': user_id, 'p_day': day})
+
+    async def _usage(self, user_id, day):
+        return await self.repo.rpc('quota_usage', {'p_user_id': user_id, 'p_day': day})
+
+
+def create_ledger(repo=None, backend=QUOTA_BACKEND):
+    backend = backend or ('supabase' if repo else 'memory')
+    if backend == 'supabase': return SupabaseQuota(repo)
+    if backend == 'sqlite': return SQLiteQuota()
+    return MemoryQuota()
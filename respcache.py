@@ -0,0 +1,75 @@
+import os, re, time, sqlite3, hashlib, logging
+from envconfig import env_pairs
+from sqlitestore import SQLiteStore, HitStats
+
+# --- کش پایدار پاسخ‌های مدل روی SQLite ---
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", "response_cache.sqlite3")
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 20000))
+# عمر پیش‌فرض هر قابلیت به ثانیه؛ با RESPONSE_CACHE_TTL="hashtags=86400,spy=3600" قابل تغییر است
+DEFAULT_TTLS = {'hashtags': 7 * 86400, 'spy': 3 * 86400, 'ideas': 86400}
+# قابلیت‌هایی که نباید کش شوند، مثل RESPONSE_CACHE_DISABLE="ideas"
+DISABLED = {f.strip() for f in os.environ.get("RESPONSE_CACHE_DISABLE", "").split(',') if f.strip()}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, feature TEXT, value TEXT, expires REAL, accessed REAL);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+"""
+
+
+def normalize(prompt):
+    return re.sub(r'\s+', ' ', prompt).strip().casefold()
+
+
+class ResponseCache(SQLiteStore, HitStats):
+    """LLM reply cache keyed on feature + model + normalized prompt, persisted in SQLite.
+
+    Every feature has its own TTL; features without one, or listed in
+    ``disabled``, are never cached. The table is trimmed to ``maxsize`` rows
+    by least-recent access. The cache is best-effort: a failing read counts
+    as a miss and a failing write is only logged, so a locked or broken file
+    never fails the request that already has its reply.
+    """
+
+    def __init__(self, path=RESPONSE_CACHE_PATH, maxsize=RESPONSE_CACHE_SIZE, ttls=None, disabled=DISABLED):
+        self.maxsize, self.disabled = maxsize, set(disabled)
+        self.ttls = {**DEFAULT_TTLS, **(ttls if ttls is not None else env_pairs("RESPONSE_CACHE_TTL", float))}
+        self._open(path, SCHEMA)
+
+    def enabled(self, feature):
+        return feature in self.ttls and feature not in self.disabled
+
+    @staticmethod
+    def _key(feature, model, prompt):
+        return hashlib.sha256(f"{feature}\0{model}\0{normalize(prompt)}".encode()).hexdigest()
+
+    def _get(self, key):
+        now = time.time()
+        row = self._db.execute("SELECT value, expires FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None: return None
+        if row[1] <= now:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            return None
+        self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def _set(self, key, feature, value):
+        now = time.time()
+        self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)", (key, feature, value, now + self.ttls[feature], now))
+        overflow = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.maxsize
+        if overflow > 0:
+            self._db.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed LIMIT ?)", (overflow,))
+
+    async def get(self, feature, model, prompt):
+        if not self.enabled(feature): return None
+        try: value = await self._run(self._get, self._key(feature, model, prompt))
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache read for {feature} failed: {e}"); value = None
+        self._count(value is not None)
+        return value
+
+    async def set(self, feature, model, prompt, value):
+        if not self.enabled(feature): return
+        try: await self._run(self._set, self._key(feature, model, prompt), feature, value)
+        except sqlite3.Error as e: logger.warning(f"Response cache write for {feature} failed: {e}")
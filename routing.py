@@ -0,0 +1,79 @@
+import os, math
+import metrics
+from envconfig import env_pairs
+
+# --- انتخاب مدل، سقف خروجی و بودجه ورودی برای هر قابلیت متنی ---
+TIERS = {'small': os.environ.get("LLM_MODEL_SMALL", "gpt-4o-mini"), 'large': os.environ.get("LLM_MODEL_LARGE", "gpt-4o")}
+DEFAULT_TIER = 'large'
+DEFAULT_INPUT_TOKENS = 4000
+
+# قابلیت: (رده مدل، سقف توکن خروجی، بودجه توکن ورودی)
+FEATURES = {
+    'hashtags': ('small', 300, 300),
+    'ideas': ('small', 1000, 800),
+    'claims': ('small', 2000, 500),
+    'script': ('large', 700, 800),
+    'coach': ('large', 700, 2000),
+    'vision': ('large', 600, 300),
+    'spy': ('large', 900, 2000),
+}
+
+# با LLM_ROUTES="hashtags=large"، LLM_MAX_TOKENS="script=900" و LLM_INPUT_TOKENS="spy=3000" قابل تغییر است
+ROUTE_TIERS = env_pairs("LLM_ROUTES")
+MAX_TOKENS = env_pairs("LLM_MAX_TOKENS", int)
+INPUT_TOKENS = env_pairs("LLM_INPUT_TOKENS", int)
+
+
+def estimate_tokens(text):
+    # تخمین محلی بدون توکنایزر: حدود ۴ نویسه لاتین یا ۲ نویسه فارسی برای هر توکن (کمی بیشتر از واقعیت)
+    latin = sum(c < '\x80' for c in text)
+    return math.ceil(latin / 4 + (len(text) - latin) / 2)
+
+
+def trim(text, budget):
+    """Shorten ``text`` to about ``budget`` tokens by cutting from the middle.
+
+    The start and end are kept because prompts put their instructions around
+    the user's text.
+    """
+    tokens = estimate_tokens(text)
+    if tokens <= budget: return text
+    keep = max(0, int(len(text) * budget / tokens) - 3)
+    tail = keep // 4
+    return text[:keep - tail] + ' … ' + (text[-tail:] if tail else '')
+
+
+def route(feature):
+    """``(model, max_tokens, input_tokens)`` for ``feature``; unknown features get the large model uncapped."""
+    tier, max_tokens, input_tokens = FEATURES.get(feature, (DEFAULT_TIER, None, DEFAULT_INPUT_TOKENS))
+    tier = ROUTE_TIERS.get(feature, tier)
+    return TIERS.get(tier, tier), MAX_TOKENS.get(feature, max_tokens), INPUT_TOKENS.get(feature, input_tokens)
+
+
+def prepare(feature, messages, model=None, kw=None):
+    """Apply the route of ``feature`` to a chat request; returns ``(messages, model, kw)``.
+
+    An explicit ``model`` or ``max_tokens`` wins over the route. Text parts of
+    user messages are trimmed so the prompt fits the feature's input budget.
+    """
+    if isinstance(messages, str): messages = [{"role": "user", "content": messages}]
+    routed, max_tokens, budget = route(feature)
+    kw = dict(kw or {})
+    if max_tokens and 'max_tokens' not in kw: kw['max_tokens'] = max_tokens
+    out, trimmed = [], False
+    for m in messages:
+        content = m.get('content')
+        if m.get('role') == 'user' and isinstance(content, str):
+            short = trim(content, budget); trimmed |= short is not content
+            m = {**m, 'content': short}
+        elif m.get('role') == 'user' and isinstance(content, list):
+            parts = []
+            for p in content:
+                if p.get('type') == 'text':
+                    short = trim(p['text'], budget); trimmed |= short is not p['text']
+                    p = {**p, 'text': short}
+                parts.append(p)
+            m = {**m, 'content': parts}
+        out.append(m)
+    if trimmed: metrics.openai_trimmed.inc(feature=feature or 'default')
+    return out, model or routed, kw
@@ -0,0 +1,141 @@
+import os, time, asyncio, logging
+from collections import deque
+import metrics
+
+# --- صف پذیرش کارهای تولیدی: سقف همزمانی کلی، یک کار در هر بخش برای هر کاربر و اولویت VIP ---
+logger = logging.getLogger(__name__)
+
+ADMISSION_CAPACITY = int(os.environ.get("ADMISSION_CAPACITY", 32))
+ADMISSION_VIP_WEIGHT = int(os.environ.get("ADMISSION_VIP_WEIGHT", 3))
+ADMISSION_REFRESH = float(os.environ.get("ADMISSION_REFRESH", 3))
+
+
+class Job:
+    """A user's claim on one feature; :meth:`admit` then waits for a global slot.
+
+    Use it as a context manager (or call :meth:`done`) so the claim and the
+    slot are released however the handler exits.
+    """
+
+    def __init__(self, scheduler, key, priority):
+        self.scheduler, self.key, self.priority = scheduler, key, priority
+        self.admitted = self.finished = False
+
+    async def admit(self, on_wait=None):
+        if not self.admitted:
+            await self.scheduler._acquire(self, on_wait)
+            self.admitted = True
+
+    def done(self):
+        if self.finished: return
+        self.finished = True
+        self.scheduler.claims.discard(self.key)
+        if self.admitted: self.scheduler._release()
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.done()
+
+
+class Scheduler:
+    """Admission control in front of OpenAI generation.
+
+    At most ``capacity`` jobs run at once; the rest wait in two FIFO lanes.
+    The priority lane (VIP and admin) is served first, but after
+    ``vip_weight`` priority admissions in a row one waiting regular job is let
+    through so the regular lane cannot starve. While waiting, ``on_wait`` is
+    called with the job's queue position whenever it changes (checked every
+    ``refresh`` seconds).
+    """
+
+    def __init__(self, capacity=ADMISSION_CAPACITY, vip_weight=ADMISSION_VIP_WEIGHT, refresh=ADMISSION_REFRESH):
+        self.capacity, self.vip_weight, self.refresh = capacity, vip_weight, refresh
+        self.running = 0
+        self.lanes = {True: deque(), False: deque()}
+        self.claims = set()
+        self._streak = 0
+
+    def claim(self, user_id, feature, priority=False):
+        """Return a :class:`Job`, or None if the user already has one for ``feature``."""
+        key = (str(user_id), feature)
+        if key in self.claims:
+            metrics.admission_rejected.inc(feature=feature); return None
+        self.claims.add(key)
+        return Job(self, key, priority)
+
+    def position(self, fut, priority):
+        lane = self.lanes[priority]
+        if fut not in lane: return 0
+        return lane.index(fut) + 1 + (0 if priority else len(self.lanes[True]))
+
+    async def _acquire(self, job, on_wait):
+        started = time.perf_counter()
+        fut = asyncio.get_running_loop().create_future()
+        self.lanes[job.priority].append(fut)
+        self._grant()
+        try:
+            shown = None
+            while not fut.done():
+                pos = self.position(fut, job.priority)
+                if on_wait and pos and pos != shown:
+                    shown = pos
+                    try: await on_wait(pos)
+                    except Exception as e: logger.debug(f"Queue position update failed: {e}")
+                await asyncio.wait({fut}, timeout=self.refresh)
+        except BaseException:
+            # اگر در همین لحظه نوبت رسیده بود، جا به نفر بعدی داده می‌شود
+            if fut.done(): self._release()
+            else:
+                fut.cancel()
+                try: self.lanes[job.priority].remove(fut)
+                except ValueError: pass
+            raise
+        metrics.admission_wait_seconds.observe(time.perf_counter() - started, lane='vip' if job.priority else 'regular')
+
+    def _release(self):
+        self.running -= 1
+        self._grant()
+
+    def _grant(self):
+        while self.running < self.capacity:
+            vip, regular = self.lanes[True], self.lanes[False]
+            if vip and (not regular or self._streak < self.vip_weight):
+                fut = vip.popleft(); self._streak += 1
+            elif regular:
+                fut = regular.popleft(); self._streak = 0
+            else: break
+            if fut.done(): continue
+            fut.set_result(None)
+            self.running += 1
+
+
+class SingleFlight:
+    """Keys of expensive actions that are running right now.
+
+    A key combines the user, the action and a hash of its input. :meth:`claim`
+    returns a :class:`Flight` for a new key, or None while the same key is
+    still running so a repeated request can be answered right away instead of
+    starting the same generation again. The key is released when the flight
+    is done.
+    """
+
+    def __init__(self):
+        self.keys = set()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def claim(self, key):
+        if key in self.keys: return None
+        self.keys.add(key)
+        return Flight(self, key)
+
+
+class Flight:
+    def __init__(self, flights, key):
+        self.flights, self.key = flights, key
+
+    def done(self):
+        self.flights.keys.discard(self.key)
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.done()
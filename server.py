@@ -0,0 +1,98 @@
+import asyncio, logging
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+# --- سرور HTTP غیرهمزمان سبک (وب‌هوک و بررسی سلامت) ---
+logger = logging.getLogger(__name__)
+
+Request = namedtuple('Request', 'method path query headers body')
+REASONS = {200: 'OK', 201: 'Created', 204: 'No Content', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 429: 'Too Many Requests', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+MAX_BODY = 1024 * 1024
+
+
+class HttpServer:
+    """Minimal HTTP/1.1 server on asyncio streams.
+
+    Handlers are ``async def handler(request) -> (status, body, content_type)``,
+    optionally with a fourth item of extra headers, registered per method and
+    path; a body that is an async iterator is sent
+    with chunked encoding. Keep-alive is supported so Telegram can reuse its
+    webhook connections.
+    """
+
+    def __init__(self, max_body=MAX_BODY):
+        self.routes = {}
+        self.max_body = max_body
+        self._server = None
+        self._conns = set()
+
+    def route(self, method, path, handler):
+        self.routes[(method, path)] = handler
+
+    async def start(self, host, port):
+        self._server = await asyncio.start_server(self._serve, host, port)
+        logger.info(f"HTTP server listening on {host}:{port}")
+
+    async def close(self):
+        if self._server:
+            self._server.close()
+            for task in list(self._conns): task.cancel()
+            await asyncio.gather(*self._conns, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader, writer):
+        task = asyncio.current_task()
+        self._conns.add(task)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line: break
+                method, target, version = line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+                headers = {}
+                while (h := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    k, _, v = h.decode('latin-1').partition(':')
+                    headers[k.strip().lower()] = v.strip()
+                length = int(headers.get('content-length') or 0)
+                if length > self.max_body:
+                    await self._respond(writer, 413, b'', 'text/plain', False); break
+                body = await reader.readexactly(length) if length else b''
+                url = urlsplit(target)
+                status, payload, ctype, *extra = await self._dispatch(Request(method, url.path, url.query, headers, body))
+                if method == 'HEAD': payload = b''
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                await self._respond(writer, status, payload, ctype, keep_alive, extra[0] if extra else None)
+                if not keep_alive: break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError): pass
+        finally:
+            self._conns.discard(task)
+            writer.close()
+            try: await writer.wait_closed()
+            except ConnectionError: pass
+
+    async def _dispatch(self, request):
+        handler = self.routes.get((request.method, request.path))
+        if handler is None and request.method == 'HEAD': handler = self.routes.get(('GET', request.path))
+        if handler is None:
+            allowed = any(p == request.path for _, p in self.routes)
+            return (405 if allowed else 404), b'', 'text/plain'
+        try: return await handler(request)
+        except Exception as e:
+            logger.error(f"HTTP handler for {request.method} {request.path} failed: {e}")
+            return 500, b'', 'text/plain'
+
+    @staticmethod
+    async def _respond(writer, status, payload, ctype, keep_alive, extra_headers=None):
+        head = f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\nContent-Type: {ctype}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n"
+        head += ''.join(f"{k}: {v}\r\n" for k, v in (extra_headers or {}).items())
+        if hasattr(payload, '__aiter__'):
+            writer.write(f"{head}Transfer-Encoding: chunked\r\n\r\n".encode('latin-1'))
+            async for chunk in payload:
+                if isinstance(chunk, str): chunk = chunk.encode()
+                if chunk: writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n"); await writer.drain()
+            writer.write(b"0\r\n\r\n")
+        else:
+            if isinstance(payload, str): payload = payload.encode()
+            writer.write(f"{head}Content-Length: {len(payload)}\r\n\r\n".encode('latin-1') + payload)
+        await writer.drain()
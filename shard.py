@@ -0,0 +1,105 @@
+import os, sys, json, hmac, asyncio, signal, logging, secrets, subprocess
+import httpx
+from telegram import Bot, Update
+from server import HttpServer
+
+# --- پروسه جلویی: تقسیم آپدیت‌ها بین ورکرها بر اساس user_id ---
+logger = logging.getLogger(__name__)
+
+WORKER_BASE_PORT = int(os.environ.get("WORKER_BASE_PORT", 9100))
+WORKER_RESTART_DELAY = float(os.environ.get("WORKER_RESTART_DELAY", 2))
+UPDATE_USER_KEYS = ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+                    'shipping_query', 'pre_checkout_query', 'my_chat_member', 'chat_member', 'chat_join_request')
+
+
+def update_user_id(data):
+    for k in UPDATE_USER_KEYS:
+        if k in data and 'from' in data[k]: return data[k]['from']['id']
+    if 'poll_answer' in data and 'user' in data['poll_answer']: return data['poll_answer']['user']['id']
+    return data.get('update_id', 0)
+
+
+def shard_for(data, workers):
+    return update_user_id(data) % workers
+
+
+class Front:
+    """Runs ``workers`` copies of the bot in webhook mode and forwards each update to
+    the worker owning its user, so one user's conversation always lands on the
+    same process. Dead workers are respawned; SIGHUP restarts them one at a time.
+    """
+
+    def __init__(self, script, workers, port, webhook_path, secret=None, webhook_url=None, token=None):
+        self.script, self.workers, self.port = script, workers, port
+        # بدون توکن محرمانه هر کسی می‌تواند به وب‌هوک ثبت‌شده آپدیت جعلی بفرستد؛ در این حالت توکن تصادفی ساخته می‌شود
+        secret = secret or (secrets.token_urlsafe(32) if webhook_url else None)
+        self.webhook_path, self.secret, self.webhook_url, self.token = webhook_path, secret, webhook_url, token
+        self.procs = [None] * workers
+        self.http = httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_keepalive_connections=workers * 4))
+        self.server = HttpServer()
+        self._stopping = False
+
+    def _spawn(self, i):
+        env = {**os.environ, 'BOT_MODE': 'webhook', 'WORKER_INDEX': str(i), 'WORKER_COUNT': str(self.workers), 'HOST': '127.0.0.1',
+               'PORT': str(WORKER_BASE_PORT + i), 'WORKERS': '1'}
+        env.pop('WEBHOOK_URL', None)
+        if self.secret: env['WEBHOOK_SECRET'] = self.secret
+        self.procs[i] = subprocess.Popen([sys.executable, self.script], env=env)
+        logger.info(f"Started worker {i} (pid {self.procs[i].pid}) on port {WORKER_BASE_PORT + i}")
+
+    async def _stop_worker(self, i):
+        p, self.procs[i] = self.procs[i], None
+        if p and p.poll() is None:
+            p.terminate()
+            try: await asyncio.wait_for(asyncio.to_thread(p.wait), 30)
+            except asyncio.TimeoutError: p.kill()
+
+    async def _supervise(self):
+        while not self._stopping:
+            for i, p in enumerate(self.procs):
+                if p and p.poll() is not None and not self._stopping:
+                    logger.warning(f"Worker {i} exited with {p.returncode}; restarting")
+                    self._spawn(i)
+            await asyncio.sleep(WORKER_RESTART_DELAY)
+
+    async def rolling_restart(self):
+        for i in range(self.workers):
+            await self._stop_worker(i); self._spawn(i)
+            await asyncio.sleep(WORKER_RESTART_DELAY)
+
+    async def _forward(self, request):
+        token = request.headers.get('x-telegram-bot-api-secret-token', '')
+        if self.secret and not hmac.compare_digest(token.encode(), self.secret.encode()): return 403, b'', 'text/plain'
+        try: data = json.loads(request.body)
+        except ValueError: return 400, b'', 'text/plain'
+        i = shard_for(data, self.workers)
+        headers = {'Content-Type': 'application/json'}
+        if self.secret: headers['X-Telegram-Bot-Api-Secret-Token'] = self.secret
+        try:
+            res = await self.http.post(f"http://127.0.0.1:{WORKER_BASE_PORT + i}{self.webhook_path}", content=request.body, headers=headers)
+            return res.status_code, b'', 'text/plain'
+        except httpx.HTTPError as e:
+            # تلگرام با دریافت خطا دوباره تلاش می‌کند
+            logger.warning(f"Forwarding update to worker {i} failed: {e}")
+            return 503, b'', 'text/plain'
+
+    async def run(self):
+        async def health(request): return 200, b"Bot is Running...", 'text/plain'
+        self.server.route('GET', '/', health)
+        self.server.route('GET', '/health', health)
+        self.server.route('POST', self.webhook_path, self._forward)
+        for i in range(self.workers): self._spawn(i)
+        await self.server.start(os.environ.get("HOST", "0.0.0.0"), self.port)
+        if self.webhook_url:
+            async with Bot(self.token) as bot:
+                await bot.set_webhook(self.webhook_url.rstrip('/') + self.webhook_path, secret_token=self.secret, allowed_updates=Update.ALL_TYPES)
+        stop, loop = asyncio.Event(), asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM): loop.add_signal_handler(sig, stop.set)
+        loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.rolling_restart()))
+        supervisor = asyncio.create_task(self._supervise())
+        try: await stop.wait()
+        finally:
+            self._stopping = True; supervisor.cancel()
+            await self.server.close()
+            await asyncio.gather(*(self._stop_worker(i) for i in range(self.workers)))
+            await self.http.aclose()
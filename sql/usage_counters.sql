@@ -0,0 +1,51 @@
+-- دفتر سهمیه روزانه: هر کاربر در هر روز (UTC) یک ردیف با تعداد مصرف‌شده و رزروشده
+create table if not exists usage_counters (
+    user_id text not null,
+    day date not null,
+    used integer not null default 0,
+    reserved integer not null default 0,
+    primary key (user_id, day)
+);
+
+-- رزرو اتمیک یک واحد؛ فقط اگر used + reserved < allowance باشد
+create or replace function reserve_quota(p_user_id text, p_day date, p_allowance integer)
+returns json language plpgsql as $$
+declare total integer;
+begin
+    insert into usage_counters (user_id, day) values (p_user_id, p_day) on conflict do nothing;
+    update usage_counters set reserved = reserved + 1
+        where user_id = p_user_id and day = p_day and used + reserved < p_allowance
+        returning used + reserved into total;
+    if found then return json_build_object('ok', true, 'total', total); end if;
+    select used + reserved into total from usage_counters where user_id = p_user_id and day = p_day;
+    return json_build_object('ok', false, 'total', total);
+end $$;
+
+create or replace function commit_quota(p_user_id text, p_day date)
+returns void language sql as $$
+    update usage_counters set used = used + 1, reserved = greatest(0, reserved - 1)
+        where user_id = p_user_id and day = p_day;
+$$;
+
+create or replace function refund_quota(p_user_id text, p_day date)
+returns void language sql as $$
+    update usage_counters set reserved = greatest(0, reserved - 1)
+        where user_id = p_user_id and day = p_day;
+$$;
+
+create or replace function quota_usage(p_user_id text, p_day date)
+returns integer language sql as $$
+    select coalesce((select used + reserved from usage_counters where user_id = p_user_id and day = p_day), 0);
+$$;
+
+-- رزروهای رهاشده (مثلاً کرش وسط تولید) روزهای گذشته را صفر می‌کند و ردیف‌های قدیمی را پاک می‌کند؛
+-- به‌صورت روزانه (pg_cron) اجرا شود. جدول logs دیگر در محاسبه سهمیه نقشی ندارد و فقط برای آمار است.
+create or replace function rollup_usage_counters(p_keep_days integer default 90)
+returns void language sql as $$
+    update usage_counters set reserved = 0 where day < current_date and reserved > 0;
+    delete from usage_counters where day < current_date - p_keep_days;
+$$;
+
+-- نمای آماری مصرف روزانه
+create or replace view daily_usage as
+    select day, count(*) as users, sum(used) as generations from usage_counters group by day;
@@ -0,0 +1,38 @@
+import sqlite3, asyncio
+
+# --- پایه مشترک فایل‌های SQLite (کش‌ها، سهمیه، تقویم محتوا، persistence) ---
+
+
+class SQLiteStore:
+    """One SQLite connection used from async code.
+
+    ``_open`` connects in autocommit mode with WAL, so several worker
+    processes can share the file, and creates the schema. ``_run`` runs a
+    blocking call in a thread, one call at a time per store.
+    """
+
+    def _open(self, path, schema, timeout=5.0):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=timeout)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(schema)
+        self._lock = asyncio.Lock()
+
+    async def _run(self, fn, *args):
+        async with self._lock: return await asyncio.to_thread(fn, *args)
+
+    def close(self):
+        self._db.close()
+
+
+class HitStats:
+    """Hit/miss counters of a cache, in the shape ``stats()`` reports them."""
+
+    hits = misses = 0
+
+    def _count(self, found):
+        if found: self.hits += 1
+        else: self.misses += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_ratio': self.hits / total if total else 0.0}
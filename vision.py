@@ -0,0 +1,47 @@
+import os, io, math
+try: from PIL import Image
+except ImportError: Image = None # بدون Pillow فقط انتخاب اندازه مناسب از تلگرام انجام می‌شود
+
+# --- آماده‌سازی تصویر برای مدل بینایی: اندازه کوچک‌تر، فشرده‌سازی و سطح جزئیات ---
+# پیش‌فرض‌ها متن‌های ریز کاور را خوانا نگه می‌دارند؛ 512 و auto (یعنی low) ارزان‌تر است ولی متن کاور ناخوانا می‌شود
+VISION_TARGET_EDGE = int(os.environ.get("VISION_TARGET_EDGE", 768))
+VISION_MAX_EDGE = int(os.environ.get("VISION_MAX_EDGE", 768))
+VISION_QUALITY = int(os.environ.get("VISION_QUALITY", 80))
+VISION_DETAIL = os.environ.get("VISION_DETAIL", "high") # auto | low | high
+
+
+def pick_photo(sizes, target=VISION_TARGET_EDGE):
+    """Smallest Telegram ``PhotoSize`` whose longer edge reaches ``target``, else the largest."""
+    sizes = sorted(sizes, key=lambda p: p.width * p.height)
+    return next((p for p in sizes if max(p.width, p.height) >= target), sizes[-1])
+
+
+def image_tokens(width, height, detail='high'):
+    # قاعده هزینه تصویر gpt-4o: ۸۵ توکن پایه و ۱۷۰ توکن برای هر کاشی ۵۱۲ پیکسلی
+    if detail == 'low': return 85
+    scale = min(1, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1, 768 / min(width, height))
+    return 85 + 170 * math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+
+
+def choose_detail(width, height, detail=VISION_DETAIL):
+    if detail != 'auto': return detail
+    return 'low' if max(width, height) <= 512 else 'high'
+
+
+def shrink(data, max_edge=VISION_MAX_EDGE, quality=VISION_QUALITY):
+    """Downscale ``data`` to ``max_edge`` and re-encode it as JPEG.
+
+    Returns ``(bytes, width, height)``, or None when Pillow is missing or the
+    image cannot be decoded; callers then send the original bytes.
+    """
+    if Image is None: return None
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img = img.convert('RGB')
+            img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            out = io.BytesIO()
+            img.save(out, 'JPEG', quality=quality, optimize=True)
+            return out.getvalue(), img.width, img.height
+    except Exception: return None